@@ -1,68 +1,457 @@
+from heapq import heappush, heappop
+from fib import aggregate as aggregate_routes
 from pprint import pprint
-# c-spell: ignore ospf inet dgram sendto
+# c-spell: ignore ospf inet dgram sendto ndarray argmin
 
-def ospf_algo(tables):
-    adjacency_list = {}
-    routers = list(tables.keys())
-    hosts = [x for y in tables.values() for x in y.keys() if x not in routers]
-    result = { router: {} for router in routers }
+# optional: rip_converge runs its rounds on arrays with numpy, and on dicts without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# links cost at least this much: over a zero cost link two nodes have equal cost routes through each
+# other, and breaking the tie by next hop can make them point at each other
+MIN_LINK_COST = 1
 
+def direct_links(table):
+    """{ dst: cost } of the directly connected entries of a routing table, costs at least MIN_LINK_COST"""
+    return { dst: max(cost, MIN_LINK_COST) for dst, (next_hop, cost) in table.items() if next_hop == dst }
+
+def ospf_links(tables):
+    """Reverse adjacency of the link graph: dst -> { router: cost } for every directly connected entry"""
+    reverse_adjacency = {}
     for router, routing_table in tables.items():
-        for dst, (next_hop, cost) in routing_table.items():
-            if cost != 1: continue
-            if dst in adjacency_list:
-                adjacency_list[dst].append(router)
+        for dst, cost in direct_links(routing_table).items():
+            if dst in reverse_adjacency:
+                reverse_adjacency[dst][router] = cost
             else:
-                adjacency_list[dst] = [router]
+                reverse_adjacency[dst] = { router: cost }
+    return reverse_adjacency
+
+def ospf_spf(reverse_adjacency, dst):
+    """Dijkstra towards dst over the reversed links; returns { node: (next_hop, cost) }.
+    Among equal cost paths the smallest next hop wins, so the tree only depends on the graph."""
+    tree = { dst: (dst, 0) }
+    visited = set()
+    heap = [(0, dst)]
+    while heap:
+        cost, node = heappop(heap)
+        if node in visited: continue
+        visited.add(node)
+        for router, link_cost in reverse_adjacency.get(node, {}).items():
+            new_cost = cost + link_cost
+            current = tree.get(router)
+            if current is None or new_cost < current[1]:
+                tree[router] = (node, new_cost)
+                heappush(heap, (new_cost, router))
+            elif new_cost == current[1] and node < current[0] and router not in visited:
+                tree[router] = (node, new_cost)
+    return tree
+
+def ospf_paths(reverse_adjacency, tree, dst, max_paths):
+    """{ router: [next_hop, ...] } for the routers of the tree of dst that have more than one next hop
+    on a shortest path, the max_paths smallest of them. The tree's own next hop is the smallest, so
+    it is always among them."""
+    paths = {}
+    for node, (_, cost) in tree.items():
+        for router, link_cost in reverse_adjacency.get(node, {}).items():
+            if router != dst and router in tree and tree[router][1] == cost + link_cost:
+                paths.setdefault(router, []).append(node)
+    return { router: sorted(hops)[:max_paths] for router, hops in paths.items() if len(hops) > 1 }
+
+def ospf_algo(tables, aggregate=False, paths=None, max_paths=1):
+    """{ router: { host: (next_hop, cost) } }. With max_paths > 1, paths is filled in with
+    { router: { host: [next_hop, ...] } } for the hosts a router reaches over several equal cost next hops."""
+    routers = set(tables.keys())
+    hosts = { x for y in tables.values() for x in y.keys() if x not in routers }
+    reverse_adjacency = ospf_links(tables)
+    result = { router: {} for router in routers }
 
     for host in hosts:
-        for neighbor in adjacency_list.get(host, []):
-            ospf_bfs(adjacency_list, result, host, host, neighbor, 1)
+        tree = ospf_spf(reverse_adjacency, host)
+        for router, entry in tree.items():
+            if router != host:
+                result[router][host] = entry
+        if paths is not None and max_paths > 1:
+            for router, hops in ospf_paths(reverse_adjacency, tree, host, max_paths).items():
+                if router in result:
+                    paths.setdefault(router, {})[host] = hops
 
+    if aggregate:
+        return { router: aggregate_routes(table) for router, table in result.items() }
     return result
 
-def ospf_bfs(adjacency_list, result, dst, prev_hop, current_hop, hops):
-    if result[current_hop].get(dst, (0, 99999999))[1] < hops:
-        return
-    result[current_hop][dst] = (prev_hop, hops)
-    for neighbor in adjacency_list.get(current_hop, []):
-        ospf_bfs(adjacency_list, result, dst, current_hop, neighbor, hops + 1)
-
-
-def rip_new_table(current_table, my_ip, new_table, new_table_src):
-    all_dst = set()
-    for dst in current_table:
-        all_dst.add(dst)
-    for dst in new_table:
-        all_dst.add(dst)
-    try:
-        all_dst.remove(my_ip)
-    except KeyError:
-        pass
 
-    result = {}
+def ospf_repair(adjacency, reverse_adjacency, tree, dst, changed_links):
+    """Repairs the tree of dst in place after changed_links ({ (router, to): old_cost or None })
+    were applied to the adjacency. Returns the nodes whose entry may have changed.
+    Ends in the same tree ospf_spf would build from scratch."""
+    touched = set()
+    heap = []
+
+    def relax(router, next_hop, cost):
+        current = tree.get(router)
+        if current is None or cost < current[1]:
+            tree[router] = (next_hop, cost)
+            touched.add(router)
+            heappush(heap, (cost, router))
+        elif cost == current[1] and next_hop < current[0]:
+            tree[router] = (next_hop, cost)
+            touched.add(router)
+
+    # a tree link that got worse or disappeared cuts off everything routed through it
+    affected = set()
+    stack = []
+    for (router, to), old_cost in changed_links.items():
+        new_cost = adjacency.get(router, {}).get(to)
+        if old_cost is None or (new_cost is not None and new_cost <= old_cost): continue
+        if router != dst and router in tree and tree[router][0] == to:
+            stack.append(router)
+    while stack:
+        node = stack.pop()
+        if node in affected: continue
+        affected.add(node)
+        for child in reverse_adjacency.get(node, {}):
+            if child not in affected and child in tree and tree[child][0] == node:
+                stack.append(child)
+
+    for node in affected:
+        del tree[node]
+    touched |= affected
+    for node in affected:
+        best = None
+        for to, cost in adjacency.get(node, {}).items():
+            if to in affected or to not in tree: continue
+            if best is None or (tree[to][1] + cost, to) < best:
+                best = (tree[to][1] + cost, to)
+        if best is not None:
+            relax(node, best[1], best[0])
+
+    # links that got better or appeared may offer shortcuts
+    for (router, to), old_cost in changed_links.items():
+        new_cost = adjacency.get(router, {}).get(to)
+        if new_cost is None or (old_cost is not None and new_cost >= old_cost): continue
+        if router != dst and to in tree:
+            relax(router, to, tree[to][1] + new_cost)
+
+    while heap:
+        cost, node = heappop(heap)
+        if node not in tree or tree[node][1] < cost: continue
+        for router, link_cost in reverse_adjacency.get(node, {}).items():
+            if router != dst:
+                relax(router, node, cost + link_cost)
+
+    return touched
+
+
+class OspfEngine:
+    """Incremental version of ospf_algo for repeated rounds.
+    Keeps the adjacency and the shortest path tree of every host between calls to update,
+    and only repairs the trees that a changed link can actually reach. With max_paths > 1,
+    paths holds the equal cost next hops like ospf_algo fills them in."""
+
+    def __init__(self, max_paths=1):
+        self.tables = {}
+        self.adjacency = {}
+        self.reverse_adjacency = {}
+        self.trees = {}
+        self.result = {}
+        self.max_paths = max_paths
+        self.host_paths = {}
+        self.paths = {}
+
+    def diff_links(self, tables):
+        changed_links = {}
+        for router in set(self.tables) | set(tables):
+            old_table = self.tables.get(router, {})
+            new_table = tables.get(router, {})
+            if old_table == new_table: continue
+            old_links = direct_links(old_table)
+            new_links = direct_links(new_table)
+            for dst, cost in new_links.items():
+                if old_links.get(dst) != cost:
+                    changed_links[(router, dst)] = old_links.get(dst)
+            for dst, cost in old_links.items():
+                if dst not in new_links:
+                    changed_links[(router, dst)] = cost
+        return changed_links
+
+    def apply_links(self, changed_links, tables):
+        for (router, dst) in changed_links:
+            new_table = tables.get(router, {})
+            entry = new_table.get(dst)
+            if entry is not None and entry[0] == dst:
+                cost = max(entry[1], MIN_LINK_COST)
+                self.adjacency.setdefault(router, {})[dst] = cost
+                self.reverse_adjacency.setdefault(dst, {})[router] = cost
+            else:
+                del self.adjacency[router][dst]
+                del self.reverse_adjacency[dst][router]
+
+    def update(self, tables):
+        """Same input and output as ospf_algo. The returned dict is reused by the next call."""
+        changed_links = self.diff_links(tables)
+        self.apply_links(changed_links, tables)
+
+        routers = set(tables.keys())
+        hosts = { x for y in tables.values() for x in y.keys() if x not in routers }
+
+        for router in list(self.result):
+            if router not in routers:
+                del self.result[router]
+        for router in routers:
+            if router not in self.result:
+                self.result[router] = {}
+
+        for host in list(self.trees):
+            if host not in hosts:
+                del self.trees[host]
+                self.host_paths.pop(host, None)
+                for routing_table in self.result.values():
+                    routing_table.pop(host, None)
+
+        for host in hosts:
+            if host in self.trees:
+                if not changed_links: continue
+                tree = self.trees[host]
+                touched = ospf_repair(self.adjacency, self.reverse_adjacency, tree, host, changed_links)
+            else:
+                tree = self.trees[host] = ospf_spf(self.reverse_adjacency, host)
+                touched = tree.keys()
+            for router in touched:
+                if router == host or router not in routers: continue
+                if router in tree:
+                    self.result[router][host] = tree[router]
+                else:
+                    self.result[router].pop(host, None)
+            # next hops of a router change with the costs of its neighbors, which are among the touched,
+            # or with its own links, which may add an equal cost next hop without touching anything
+            if self.max_paths > 1 and (touched or any(router in tree and to in tree for router, to in changed_links)):
+                self.host_paths[host] = ospf_paths(self.reverse_adjacency, tree, host, self.max_paths)
+
+        if self.max_paths > 1:
+            self.paths = {}
+            for host, host_paths in self.host_paths.items():
+                for router, hops in host_paths.items():
+                    if router in routers:
+                        self.paths.setdefault(router, {})[host] = hops
+        self.tables = dict(tables)
+        return self.result
+
+
+def link_state_spf(lsdb, root):
+    """Routes of root from a link-state database { router: (seq, { neighbor: cost }) }, as
+    { dst: (next_hop, cost) } for every node root reaches. A link between two routers is only used
+    if both list it; nodes without an entry (hosts) are destinations, never transit.
+    Among equal cost paths the smallest next hop wins, like in ospf_spf."""
+    routes = {}
+    tentative = {}
+    heap = [(0, None, root)]
+    while heap:
+        cost, next_hop, node = heappop(heap)
+        if node in routes: continue
+        routes[node] = (next_hop, cost)
+        entry = lsdb.get(node)
+        if entry is None: continue
+        for neighbor, link_cost in entry[1].items():
+            if neighbor in routes: continue
+            other = lsdb.get(neighbor)
+            if other is not None and node not in other[1]: continue
+            candidate = (cost + max(link_cost, MIN_LINK_COST), next_hop or neighbor)
+            current = tentative.get(neighbor)
+            if current is None or candidate < current:
+                tentative[neighbor] = candidate
+                heappush(heap, (*candidate, neighbor))
+    del routes[root]
+    return routes
 
-    for dst in all_dst:
-        current_min = 99999999
-        best_next_hop = None
-        for this_dst, (next_hop, cost) in current_table.items():
-            if this_dst == dst and cost < current_min:
-                current_min = cost
-                best_next_hop = next_hop
 
-        cost_of_me_to_new_table_src = current_table.get(new_table_src, [0, 1])[1]
-        for this_dst, (next_hop, cost) in new_table.items():
-            if this_dst == dst and cost + cost_of_me_to_new_table_src < current_min:
-                current_min = cost + cost_of_me_to_new_table_src
-                best_next_hop = new_table_src
+ADDED = 'added'
+COST_CHANGED = 'cost-changed'
+NEXT_HOP_CHANGED = 'next-hop-changed'
+REMOVED = 'removed'
+# only the equal cost next hops changed, neighbors don't need to hear about it
+PATHS_CHANGED = 'paths-changed'
 
-        assert best_next_hop is not None
-        result[dst] = (best_next_hop, current_min)
+# cost of a withdrawn route, the largest cost the binary wire format carries
+INFINITY = 0xffff
 
-    if result == current_table:
+def rip_merge(table, my_ip, new_table, new_table_src, paths=None, max_paths=1):
+    """Merges new_table, as received from new_table_src, into table in place.
+    A cheaper route always wins; the route we already use through new_table_src follows whatever
+    new_table_src now says, and is removed if that is INFINITY (withdrawn or poisoned).
+    With max_paths > 1, paths ({ dst: [next_hop, ...] }, only for destinations with more than one)
+    keeps up to max_paths neighbors offering the cost of the route in use, and when the next hop in
+    use gets worse the route moves to another of them at the same cost.
+    Returns { dst: ADDED | COST_CHANGED | NEXT_HOP_CHANGED | REMOVED | PATHS_CHANGED } for every entry that changed"""
+    changes = {}
+    multipath = paths is not None and max_paths > 1
+    if my_ip in table:
+        del table[my_ip]
+        changes[my_ip] = REMOVED
+        if paths is not None:
+            paths.pop(my_ip, None)
+
+    cost_of_me_to_new_table_src = table.get(new_table_src, (0, 1))[1]
+    for dst, (next_hop, cost) in new_table.items():
+        if dst == my_ip: continue
+        cost += cost_of_me_to_new_table_src
+        current = table.get(dst)
+        if current is None:
+            if cost >= INFINITY: continue
+            changes[dst] = ADDED
+        elif cost < current[1]:
+            changes[dst] = COST_CHANGED if current[0] == new_table_src else NEXT_HOP_CHANGED
+            if paths is not None:
+                paths.pop(dst, None)
+        elif current[0] != new_table_src:
+            if not multipath: continue
+            hops = paths.get(dst)
+            if cost == current[1] and (hops is None or (new_table_src not in hops and len(hops) < max_paths)):
+                paths[dst] = sorted((hops or [current[0]]) + [new_table_src])
+                changes[dst] = PATHS_CHANGED
+            elif cost != current[1] and hops is not None and new_table_src in hops:
+                hops.remove(new_table_src)
+                if len(hops) == 1:
+                    del paths[dst]
+                changes[dst] = PATHS_CHANGED
+            continue
+        elif cost == current[1]:
+            continue
+        elif multipath and dst in paths:
+            hops = paths[dst]
+            hops.remove(new_table_src)
+            table[dst] = (hops[0], current[1])
+            if len(hops) == 1:
+                del paths[dst]
+            changes[dst] = NEXT_HOP_CHANGED
+            continue
+        elif cost >= INFINITY:
+            del table[dst]
+            changes[dst] = REMOVED
+            continue
+        else:
+            changes[dst] = COST_CHANGED
+        table[dst] = (new_table_src, cost)
+
+    return changes
+
+def rip_new_table(current_table, my_ip, new_table, new_table_src, aggregate=False):
+    result = { dst: (next_hop, cost) for dst, (next_hop, cost) in current_table.items() }
+    if not rip_merge(result, my_ip, new_table, new_table_src):
         return None
+    return aggregate_routes(result) if aggregate else result
 
-    return result
+
+# entries of a block of destination columns handled at once by rip_rounds_arrays, bounds its memory
+ROUND_BLOCK = 1 << 22
+
+def rip_converge(tables, max_rounds=None, vectorized=None):
+    """The tables RIP converges to from the links of tables (the directly connected entries), computed
+    as synchronous Bellman-Ford rounds: in every round each router takes the best route its router
+    neighbors had in the previous one. Among equal cost routes the smallest next hop wins, so the
+    host routes are the ones ospf_algo computes. Rounds run on arrays with numpy (vectorized=None picks
+    it when installed), otherwise on dicts.
+    Returns ({ router: { dst: (next_hop, cost) } }, [entries changed in each round])"""
+    links = { router: direct_links(table) for router, table in tables.items() }
+    if vectorized is None:
+        vectorized = numpy is not None
+    rounds = rip_rounds_arrays if vectorized else rip_rounds_dicts
+    return rounds(links, max_rounds)
+
+def rip_rounds_dicts(links, max_rounds=None):
+    """rip_converge on { router: { dst: cost } } links, one dict per router"""
+    # (cost, next_hop), so comparing tuples picks the smallest next hop among equal costs
+    hosts = { router: { dst: (cost, dst) for dst, cost in router_links.items() if dst not in links } for router, router_links in links.items() }
+    routes = hosts
+    changes = []
+    while max_rounds is None or len(changes) < max_rounds:
+        new_routes = {}
+        changed = 0
+        for router, router_links in links.items():
+            best = dict(hosts[router])
+            for neighbor, link_cost in router_links.items():
+                if neighbor not in links: continue
+                candidate = (link_cost, neighbor)
+                if neighbor not in best or candidate < best[neighbor]:
+                    best[neighbor] = candidate
+                for dst, (cost, _) in routes[neighbor].items():
+                    if dst == router: continue
+                    candidate = (cost + link_cost, neighbor)
+                    current = best.get(dst)
+                    if current is None or candidate < current:
+                        best[dst] = candidate
+            old = routes[router]
+            changed += sum(old.get(dst) != entry for dst, entry in best.items()) + sum(dst not in best for dst in old)
+            new_routes[router] = best
+        routes = new_routes
+        if not changed:
+            break
+        changes.append(changed)
+    return { router: { dst: (next_hop, cost) for dst, (cost, next_hop) in table.items() } for router, table in routes.items() }, changes
+
+def rip_rounds_arrays(links, max_rounds=None):
+    """rip_converge on { router: { dst: cost } } links with numpy. Every route is one int64 key,
+    cost * n + rank of the next hop among all n nodes, so a min over the keys picks the cheapest
+    route and then the smallest next hop. A round is a min-plus product of the router links with the
+    keys of the previous round: rows are sorted by router degree, so the j-th neighbors of the routers
+    that have one are the first rows, and each of them is one gather and one in-place minimum, over
+    ROUND_BLOCK entries at a time. The keys take 8 bytes per router and destination, three times."""
+    nodes = sorted(set(links).union(*links.values()))
+    n = len(nodes)
+    if n == 0:
+        return {}, []
+    index = { node: i for i, node in enumerate(nodes) }
+    neighbors = { router: sorted(dst for dst in router_links if dst in links) for router, router_links in links.items() }
+    routers = sorted(links, key=lambda router: -len(neighbors[router]))
+    row = { router: i for i, router in enumerate(routers) }
+    unreachable = (1 << 62) // n * n
+
+    # initial keys: the router itself at cost 0, its hosts over their links, nothing else yet
+    base = numpy.full((len(routers), n), unreachable, dtype=numpy.int64)
+    for router in routers:
+        base[row[router], index[router]] = 0
+        for dst, cost in links[router].items():
+            if dst not in links:
+                base[row[router], index[dst]] = min(base[row[router], index[dst]], cost * n + index[dst])
+    slots = []
+    for j in range(len(neighbors[routers[0]]) if routers else 0):
+        slot = [router for router in routers if len(neighbors[router]) > j]
+        slots.append((
+            numpy.array([row[neighbors[router][j]] for router in slot], dtype=numpy.int64),
+            numpy.array([[links[router][neighbors[router][j]]] for router in slot], dtype=numpy.int64),
+            numpy.array([[index[neighbors[router][j]]] for router in slot], dtype=numpy.int64),
+        ))
+    block = max(1, ROUND_BLOCK // max(len(routers), 1))
+
+    keys = base.copy()
+    changes = []
+    while max_rounds is None or len(changes) < max_rounds:
+        costs = keys // n
+        new_keys = base.copy()
+        for first in range(0, n, block):
+            columns = slice(first, first + block)
+            target = new_keys[:, columns]
+            for neighbor_rows, link_costs, ranks in slots:
+                candidates = costs[neighbor_rows, columns]
+                candidates += link_costs
+                candidates *= n
+                candidates += ranks
+                rows = target[:len(neighbor_rows)]
+                numpy.minimum(rows, candidates, out=rows)
+        changed = int(numpy.count_nonzero(new_keys != keys))
+        keys = new_keys
+        if not changed:
+            break
+        changes.append(changed)
+
+    result = {}
+    for router in sorted(links):
+        router_keys = keys[row[router]]
+        reached = numpy.flatnonzero(router_keys < unreachable)
+        costs, ranks = numpy.divmod(router_keys[reached], n)
+        result[router] = { nodes[i]: (nodes[rank], cost) for i, cost, rank in zip(reached.tolist(), costs.tolist(), ranks.tolist()) if i != index[router] }
+    return result, changes
 
 
 if __name__ == '__main__':
@@ -122,6 +511,116 @@ if __name__ == '__main__':
      'r2': {'h1': ('r1', 2), 'h2': ('h2', 1), 'h3': ('r3', 2)},
      'r3': {'h1': ('r1', 2), 'h2': ('r2', 2), 'h3': ('h3', 1)}}
 
+    # weighted links, same graph as table3 below with a host hanging off z
+    table4 = {
+        'u': { 'v': ('v', 1), 'y': ('y', 2) },
+        'v': { 'u': ('u', 1), 'z': ('z', 6), 'x': ('x', 3) },
+        'z': { 'v': ('v', 6), 'x': ('x', 2), 'h': ('h', 1) },
+        'x': { 'v': ('v', 3), 'z': ('z', 2), 'y': ('y', 3) },
+        'y': { 'u': ('u', 2), 'x': ('x', 3) },
+    }
+    assert ospf_algo(table4) == \
+    {'u': {'h': ('v', 7)},
+     'v': {'h': ('x', 6)},
+     'x': {'h': ('z', 3)},
+     'y': {'h': ('x', 6)},
+     'z': {'h': ('h', 1)}}
+
+    # long chains used to hit the recursion limit
+    chain = { f'r{i}': { f'r{i - 1}': (f'r{i - 1}', 1), f'r{i + 1}': (f'r{i + 1}', 1) } for i in range(1, 4999) }
+    chain['r0'] = { 'h': ('h', 1), 'r1': ('r1', 1) }
+    chain['r4999'] = { 'r4998': ('r4998', 1) }
+    assert ospf_algo(chain)['r4999'] == {'h': ('r4998', 5000)}
+
+    # hosts behind the same router collapse into one prefix
+    table5 = {
+        '10.0.0.101': { '10.0.0.102': ('10.0.0.102', 1), **{ f'10.0.0.{i}': (f'10.0.0.{i}', 1) for i in range(4, 8) } },
+        '10.0.0.102': { '10.0.0.101': ('10.0.0.101', 1), '10.0.0.1': ('10.0.0.1', 1) },
+    }
+    assert ospf_algo(table5, aggregate=True) == \
+    {'10.0.0.101': {'10.0.0.1': ('10.0.0.102', 2), '10.0.0.4': ('10.0.0.4', 1), '10.0.0.5': ('10.0.0.5', 1),
+                    '10.0.0.6': ('10.0.0.6', 1), '10.0.0.7': ('10.0.0.7', 1)},
+     '10.0.0.102': {'10.0.0.1': ('10.0.0.1', 1), '10.0.0.4/30': ('10.0.0.101', 2)}}
+    assert rip_new_table(table5['10.0.0.102'], '10.0.0.102', table5['10.0.0.101'], '10.0.0.101', aggregate=True) == \
+        {'10.0.0.101': ('10.0.0.101', 1), '10.0.0.1': ('10.0.0.1', 1), '10.0.0.4/30': ('10.0.0.101', 2)}
+
+    # incremental rounds must match a full recompute after every change
+    import random
+    from copy import deepcopy
+    rng = random.Random(358)
+    routers = [f'r{i}' for i in range(30)]
+    tables = { router: {} for router in routers }
+    def set_link(a, b, cost):
+        tables[a][b] = (b, cost)
+        tables[b][a] = (a, cost)
+    for i in range(1, len(routers)):
+        set_link(routers[i], routers[rng.randrange(i)], rng.randint(1, 5))
+    for i in range(10):
+        tables[rng.choice(routers)][f'h{i}'] = (f'h{i}', 1)
+    engine = OspfEngine(max_paths=2)
+    for _ in range(200):
+        a, b = rng.sample(routers, 2)
+        if b in tables[a] and rng.random() < 0.4:
+            del tables[a][b]
+            del tables[b][a]
+        else:
+            # zero cost links count as MIN_LINK_COST
+            set_link(a, b, rng.randint(0, 5))
+        paths = {}
+        assert engine.update(deepcopy(tables)) == ospf_algo(tables, paths=paths, max_paths=2)
+        assert engine.paths == paths
+
+    # equal cost paths around a square: r1 reaches h over both r2 and r3
+    square = {
+        'r1': { 'r2': ('r2', 1), 'r3': ('r3', 1) },
+        'r2': { 'r1': ('r1', 1), 'r4': ('r4', 1) },
+        'r3': { 'r1': ('r1', 1), 'r4': ('r4', 1) },
+        'r4': { 'r2': ('r2', 1), 'r3': ('r3', 1), 'h': ('h', 1) },
+    }
+    paths = {}
+    assert ospf_algo(square, paths=paths, max_paths=4)['r1'] == {'h': ('r2', 3)}
+    assert paths == {'r1': {'h': ['r2', 'r3']}}
+    paths = {}
+    ospf_algo(square, paths=paths, max_paths=1)
+    assert paths == {}
+
+    # every router computing its own routes from the flooded links agrees with the monitor
+    def lsdb_of(tables):
+        return { router: (1, { dst: cost for dst, (next_hop, cost) in table.items() if next_hop == dst }) for router, table in tables.items() }
+    for graph in (table1, table2, table4, tables):
+        result = ospf_algo(graph)
+        lsdb = lsdb_of(graph)
+        for router in graph:
+            routes = link_state_spf(lsdb, router)
+            assert { dst: entry for dst, entry in routes.items() if dst not in graph } == result[router]
+    # a link only one side lists is not used
+    lsdb = lsdb_of(table2)
+    lsdb['r2'] = (2, { 'h2': 1, 'r3': 1 })
+    assert link_state_spf(lsdb, 'r1') == {'h1': ('h1', 1), 'r3': ('r3', 1), 'h3': ('r3', 2), 'r2': ('r3', 2), 'h2': ('r3', 3)}
+
+
+    # batch rounds end in the tables of the per message loop below, with ospf_algo's host routes
+    for graph in (table1, table2, table4, tables):
+        for vectorized in (False, True) if numpy is not None else (False,):
+            converged, changes = rip_converge(graph, vectorized=vectorized)
+            result = ospf_algo(graph)
+            for router in graph:
+                assert { dst: entry for dst, entry in converged[router].items() if dst not in graph } == result[router]
+    converged, changes = rip_converge(table1)
+    assert converged['r1'] == {'h1': ('h1', 1), 'h2': ('h2', 1), 'r2': ('r2', 1), 'h3': ('r2', 2), 'h4': ('r2', 2)}
+    assert changes == [6]
+    assert rip_converge(table1, max_rounds=0) == ({'r1': {'h1': ('h1', 1), 'h2': ('h2', 1)}, 'r2': {'h3': ('h3', 1), 'h4': ('h4', 1)}}, [])
+    assert rip_converge(table4, max_rounds=1)[0]['u'] == {'v': ('v', 1), 'y': ('y', 2)}
+    assert rip_converge({}, vectorized=False) == ({}, [])
+    # a zero cost link doesn't make r0 and r2 route h3 through each other
+    zero_cost = {'r0': {'r2': ('r2', 0)}, 'r1': {'h3': ('h3', 2), 'r2': ('r2', 3)}, 'r2': {'r1': ('r1', 3), 'r0': ('r0', 0)}}
+    assert ospf_algo(zero_cost)['r2']['h3'] == ('r1', 5)
+    assert ospf_algo(zero_cost)['r0']['h3'] == ('r2', 6)
+    for vectorized in (False, True) if numpy is not None else (False,):
+        assert rip_converge(zero_cost, vectorized=vectorized)[0]['r2']['h3'] == ('r1', 5)
+    if numpy is not None:
+        assert rip_converge(tables, vectorized=True) == rip_converge(tables, vectorized=False)
+        assert rip_converge({}, vectorized=True) == ({}, [])
 
     assert rip_new_table(table1['r1'], 'r1', table1['r2'], 'r2') == \
         {'h1': ('h1', 1),
@@ -137,6 +636,33 @@ if __name__ == '__main__':
         'h4': ('h4', 1),
         'r1': ('r1', 1)}
 
+    table = { 'h1': ['h1', 1], 'r2': ('r2', 1), 'h3': ('r2', 5), 'r1': ('r1', 1) }
+    assert rip_merge(table, 'r1', { 'h3': ('h3', 1), 'h4': ('h4', 1), 'h1': ('r1', 2) }, 'r2') == \
+        {'r1': REMOVED, 'h3': COST_CHANGED, 'h4': ADDED}
+    assert table == {'h1': ['h1', 1], 'r2': ('r2', 1), 'h3': ('r2', 2), 'h4': ('r2', 2)}
+    assert rip_merge(table, 'r1', { 'h1': ('h1', 1) }, 'r2') == {}
+    assert rip_new_table(table, 'r1', { 'h3': ('h3', 1) }, 'h5') is None
+    assert rip_merge(table, 'r1', { 'h4': ('h4', 0) }, 'h1') == {'h4': NEXT_HOP_CHANGED}
+    # worse news and withdrawals are only taken from the next hop in use
+    assert rip_merge(table, 'r1', { 'h3': ('h3', 4), 'h4': ('x', INFINITY), 'h5': ('x', INFINITY) }, 'r2') == {'h3': COST_CHANGED}
+    assert rip_merge(table, 'r1', { 'h4': ('x', INFINITY) }, 'h1') == {'h4': REMOVED}
+    assert table == {'h1': ['h1', 1], 'r2': ('r2', 1), 'h3': ('r2', 5)}
+
+    # equal cost next hops: kept, dropped when they get worse, and taken over when the one in use withdraws
+    table = { 'r2': ('r2', 1), 'r3': ('r3', 1), 'r4': ('r4', 1), 'h': ('r2', 3) }
+    paths = {}
+    assert rip_merge(table, 'r1', { 'h': ('x', 2) }, 'r3', paths, max_paths=2) == {'h': PATHS_CHANGED}
+    assert rip_merge(table, 'r1', { 'h': ('x', 2) }, 'r4', paths, max_paths=2) == {}
+    assert paths == {'h': ['r2', 'r3']}
+    assert rip_merge(table, 'r1', { 'h': ('r1', INFINITY) }, 'r2', paths, max_paths=2) == {'h': NEXT_HOP_CHANGED}
+    assert table['h'] == ('r3', 3) and paths == {}
+    assert rip_merge(table, 'r1', { 'h': ('x', 2) }, 'r4', paths, max_paths=2) == {'h': PATHS_CHANGED}
+    assert rip_merge(table, 'r1', { 'h': ('x', 4) }, 'r4', paths, max_paths=2) == {'h': PATHS_CHANGED}
+    assert table['h'] == ('r3', 3) and paths == {}
+    assert rip_merge(table, 'r1', { 'h': ('x', 2) }, 'r4', paths, max_paths=2) == {'h': PATHS_CHANGED}
+    assert rip_merge(table, 'r1', { 'h': ('x', 1) }, 'r2', paths, max_paths=2) == {'h': NEXT_HOP_CHANGED}
+    assert table['h'] == ('r2', 2) and paths == {}
+
     # graph: https://imgur.com/a/WIMfiQf
     # From tut 07 Q4
     table3 = {
@@ -148,6 +674,7 @@ if __name__ == '__main__':
         'y': { 'u': ('u', 2), 'x': ('x', 3) },
     }
 
+    links3 = deepcopy(table3)
     nodes = list(table3.keys())
     neighbors = { node: table3[node].keys() for node in nodes }
 
@@ -162,6 +689,10 @@ if __name__ == '__main__':
             for neighbor in neighbors[update_for]:
                 update_queue.append((neighbor, update_for, updated_table))
 
+    converged, _ = rip_converge(links3)
+    assert { node: { dst: cost for dst, (_, cost) in table.items() } for node, table in converged.items() } == \
+        { node: { dst: cost for dst, (_, cost) in table.items() } for node, table in table3.items() }
+
     assert table3 == \
     {'u': {'v': ('v', 1), 'x': ('v', 4), 'y': ('y', 2), 'z': ('v', 6)},
     'v': {'u': ('u', 1), 'x': ('x', 3), 'y': ('u', 3), 'z': ('x', 5)},
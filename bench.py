@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""Benchmarks for the routing algorithms and the wire format on generated topologies.
+
+Every case is timed for ops/sec, the best of several repeats, and measured once more under
+tracemalloc for its peak memory. Results go to a JSON file and are compared against a stored
+baseline; any case that got slower or bigger than the tolerance allows is reported and makes the
+run exit with status 1. Each timed batch is followed by one of a calibration case that doesn't use
+any code of the repo, and speeds are compared as the median ratio of the two, so neither a faster
+or slower machine nor one whose speed changes from one second to the next reads as a regression.
+
+    python bench.py --quick
+    python bench.py --sizes 10 100 1000 10000 --shapes grid fat-tree
+    python bench.py --save-baseline
+"""
+# c-spell: ignore ospf tracemalloc
+
+import argparse
+import gc
+import heapq
+import json
+import logging
+import statistics
+import sys
+import time
+import tracemalloc
+from collections import deque
+from algo import ospf_algo, rip_new_table, rip_converge, link_state_spf, numpy
+from host import logger
+from sim import generate
+from wire import encode, decode
+
+SHAPES = ['line', 'ring', 'grid', 'random', 'scale-free', 'fat-tree']
+SIZES = [10, 100, 1000, 10000]
+QUICK_SIZES = [10, 100, 1000]
+CASES = ['ospf_algo', 'link_state_spf', 'rip_new_table', 'rip_convergence', 'rip_converge', 'encode', 'decode']
+
+# hosts are the destinations ospf_algo runs Dijkstra for, so they are capped to keep 10k routers tractable
+MAX_HOSTS = 100
+# the queue loop sends whole tables around until nothing changes, which is quadratic or worse
+MAX_RIP_CONVERGENCE_SIZE = 300
+# the batch rounds on arrays keep an int64 per router and destination; on dicts they are as slow as
+# the queue loop and stop at its size
+MAX_RIP_CONVERGE_SIZE = 3000
+# memory growth below this many bytes is noise, not a regression
+MEMORY_SLACK = 64 * 1024
+# timed runs of each case, each followed by a run of the calibration case
+REPEATS = 7
+
+
+def link_tables(shape, n, seed=0):
+    """{ router: { neighbor: (neighbor, 1) } } for a generated topology, hosts included as neighbors"""
+    links, host_links = generate(shape, n, min(max(n // 10, 1), MAX_HOSTS), seed)
+    tables = {}
+    for a, b in links:
+        tables.setdefault(a, {})[b] = (b, 1)
+        tables.setdefault(b, {})[a] = (a, 1)
+    for host, router in host_links:
+        tables.setdefault(router, {})[host] = (host, 1)
+    return tables
+
+def converged_table(tables, src):
+    """The table RIP converges to at src: every reachable node with its first hop and hop count"""
+    table = {}
+    queue = deque()
+    for neighbor in tables[src]:
+        table[neighbor] = (neighbor, 1)
+        queue.append(neighbor)
+    while queue:
+        node = queue.popleft()
+        next_hop, cost = table[node]
+        for neighbor in tables.get(node, ()):
+            if neighbor != src and neighbor not in table:
+                table[neighbor] = (next_hop, cost + 1)
+                queue.append(neighbor)
+    return table
+
+def rip_convergence(tables):
+    """The table3 queue loop in algo.py, run on a copy of tables until no table changes"""
+    tables = { router: dict(table) for router, table in tables.items() }
+    neighbors = { router: [n for n in table if n in tables] for router, table in tables.items() }
+    first = next(iter(tables))
+    update_queue = deque((n, first, tables[first]) for n in neighbors[first])
+    while update_queue:
+        update_for, update_from, update_table = update_queue.popleft()
+        updated_table = rip_new_table(tables[update_for], update_for, update_table, update_from)
+        if updated_table is not None:
+            tables[update_for] = updated_table
+            for neighbor in neighbors[update_for]:
+                update_queue.append((neighbor, update_for, updated_table))
+    return tables
+
+
+def calibration():
+    """Fixed work like the routing code does, dicts, tuples, strings and a heap, that no change to the
+    repo makes faster or slower. Its speed says how fast the machine is right now."""
+    table = {}
+    heap = []
+    for i in range(2000):
+        ip = f'10.0.{i >> 8}.{i & 255}'
+        table[ip] = (ip, i % 17)
+        heapq.heappush(heap, (i * 7919 % 2003, ip))
+    while heap:
+        cost, ip = heapq.heappop(heap)
+        if table[ip][1] > cost:
+            table[ip] = (ip, cost)
+    return sorted(table.items())
+
+def cases(shape, n, selected):
+    """(name, function) for every benchmark case of one topology"""
+    tables = link_tables(shape, n)
+    # the busiest router and one of its router neighbors, so tables are as large as they get
+    src = max(tables, key=lambda router: len(tables[router]))
+    neighbor = next(n for n in tables[src] if n in tables)
+    table = converged_table(tables, neighbor)
+    message = { 'rip-update': table, 'src': neighbor, 'dst': src, 'seq': 1, 'delta': False }
+    direct = dict(tables[src])
+    lsdb = { router: (1, { dst: cost for dst, (_, cost) in table.items() }) for router, table in tables.items() }
+
+    if 'ospf_algo' in selected:
+        yield 'ospf_algo', lambda: ospf_algo(tables)
+    if 'link_state_spf' in selected:
+        yield 'link_state_spf', lambda: link_state_spf(lsdb, src)
+    if 'rip_new_table' in selected:
+        yield 'rip_new_table', lambda: rip_new_table(direct, src, table, neighbor)
+    if 'rip_convergence' in selected and len(tables) <= MAX_RIP_CONVERGENCE_SIZE:
+        yield 'rip_convergence', lambda: rip_convergence(tables)
+    # both engines under their own names, so the cases don't change with what is installed
+    if 'rip_converge' in selected and len(tables) <= MAX_RIP_CONVERGENCE_SIZE:
+        yield 'rip_converge-dicts', lambda: rip_converge(tables, vectorized=False)
+    if 'rip_converge' in selected and numpy is not None and len(tables) <= MAX_RIP_CONVERGE_SIZE:
+        yield 'rip_converge-numpy', lambda: rip_converge(tables, vectorized=True)
+    for format in ('binary', 'json'):
+        payload = encode(message, format)
+        if 'encode' in selected:
+            yield f'encode-{format}', lambda format=format: encode(message, format)
+        if 'decode' in selected:
+            yield f'decode-{format}', lambda payload=payload: decode(payload)
+
+def timed(function, batch):
+    """Seconds batch calls of function take"""
+    started = time.perf_counter()
+    for _ in range(batch):
+        function()
+    return time.perf_counter() - started
+
+def measure(function, min_time, calibration_time, repeats=REPEATS):
+    """(ops/sec, speed relative to the calibration case, peak bytes allocated) of function.
+    The batch size is doubled until a batch takes min_time / repeats / 2, then repeats batches are
+    timed, each followed by calibration calls for about as long. The fastest batch gives ops/sec;
+    the median of the ratios of each batch to the calibration right after it is the relative speed,
+    which holds up while the machine gets faster or slower in between. Like timeit, the garbage
+    collector is off while timing, so how much earlier cases left on the heap doesn't count."""
+    function()
+    gc.collect()
+    gc.disable()
+    try:
+        batch = 1
+        while timed(function, batch) < min_time / repeats / 2:
+            batch *= 2
+        ratios = []
+        fastest = None
+        for _ in range(repeats):
+            elapsed = timed(function, batch)
+            calibration_batch = max(round(elapsed / calibration_time), 1)
+            ratios.append(calibration_batch / timed(calibration, calibration_batch) * elapsed / batch)
+            fastest = elapsed if fastest is None else min(fastest, elapsed)
+    finally:
+        gc.enable()
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return batch / fastest, 1 / statistics.median(ratios), peak
+
+def run(shapes, sizes, selected, min_time):
+    calibration()
+    calibration_time = min(timed(calibration, 1) for _ in range(REPEATS))
+    results = {}
+    for shape in shapes:
+        for n in sizes:
+            for name, function in cases(shape, n, selected):
+                key = f'{name}/{shape}/{n}'
+                ops, relative, peak = measure(function, min_time, calibration_time)
+                results[key] = { 'ops_per_sec': ops, 'relative': relative, 'peak_bytes': peak }
+                print(f'{key:40} {ops:14.1f} ops/s {relative:12.4f} x cal {peak / 1024:12.1f} KiB', flush=True)
+    return results
+
+def regressions(results, baseline, tolerance):
+    """Descriptions of every case that is slower or uses more memory than baseline allows. Speeds
+    are compared relative to the calibration case, or as ops/sec against an older baseline."""
+    found = []
+    for key, result in results.items():
+        expected = baseline.get(key)
+        if expected is None: continue
+        if 'relative' in expected:
+            if result['relative'] < expected['relative'] * (1 - tolerance):
+                found.append(f"{key}: {result['relative']:.4f} x calibration, baseline {expected['relative']:.4f} x calibration")
+        elif result['ops_per_sec'] < expected['ops_per_sec'] * (1 - tolerance):
+            found.append(f"{key}: {result['ops_per_sec']:.1f} ops/s, baseline {expected['ops_per_sec']:.1f} ops/s")
+        if result['peak_bytes'] > expected['peak_bytes'] * (1 + tolerance) + MEMORY_SLACK:
+            found.append(f"{key}: {result['peak_bytes']} peak bytes, baseline {expected['peak_bytes']} peak bytes")
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark ospf_algo, link_state_spf, rip_new_table, rip_converge and the wire format')
+    parser.add_argument('--quick', action='store_true', help=f'only sizes {QUICK_SIZES}')
+    parser.add_argument('--sizes', type=int, nargs='+', help=f'number of routers (default: {SIZES})')
+    parser.add_argument('--shapes', nargs='+', choices=SHAPES, default=SHAPES)
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=CASES)
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds to spend timing each case')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', default='bench_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to the baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=0.3, help='allowed fraction of slowdown or memory growth')
+    args = parser.parse_args()
+
+    logger.setLevel(logging.CRITICAL)
+    sizes = args.sizes or (QUICK_SIZES if args.quick else SIZES)
+    results = run(args.shapes, sizes, set(args.cases), args.min_time)
+
+    with open(args.baseline if args.save_baseline else args.output, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    if args.save_baseline:
+        sys.exit(0)
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f'No baseline at {args.baseline}, nothing to compare against')
+        sys.exit(0)
+    found = regressions(results, baseline, args.tolerance)
+    for regression in found:
+        print(f'REGRESSION {regression}')
+    if found:
+        sys.exit(1)
+    print(f'No regressions against {args.baseline}')
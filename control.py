@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Thin client for the control socket of a running node (`host.py start`).
+
+Every command is one line, exactly as it would follow `host.py` on the command line, and the
+node answers every line with 'ok' or 'error: <reason>'. One connection carries any number of
+commands, so scripted runs don't pay for an interpreter start per command.
+
+    python control.py send 3 5
+    python control.py -n 1000 send 3
+    python control.py -f commands.txt
+"""
+# c-spell: ignore makefile
+
+import argparse
+import os
+import socket
+import sys
+import time
+from discovery import get_my_ip
+
+CONTROL_SOCKET = os.environ.get('CONTROL_SOCKET', '/tmp/host-{ip}.sock')
+
+# commands sent before reading their replies, keeps both socket buffers from filling up
+WINDOW = 1024
+
+
+def control_path(ip=None):
+    return CONTROL_SOCKET.format(ip=ip or get_my_ip())
+
+def send_commands(commands, path):
+    """Runs commands on the node listening on path, returns one reply per command"""
+    replies = []
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        responses = s.makefile('rb')
+        for i in range(0, len(commands), WINDOW):
+            window = commands[i:i + WINDOW]
+            s.sendall(''.join(f'{command}\n' for command in window).encode())
+            replies += [responses.readline().decode().rstrip('\n') for _ in window]
+    return replies
+
+def read_commands(file):
+    """Non-empty lines of a command file, without # comments"""
+    lines = (line.split('#', 1)[0].strip() for line in file)
+    return [line for line in lines if line]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Send commands to the running node on this machine')
+    parser.add_argument('command', nargs='*', help='a host.py command, e.g. send 3 5')
+    parser.add_argument('-f', '--file', type=argparse.FileType('r'), help="file with one command per line, '-' for stdin")
+    parser.add_argument('-n', '--repeat', type=int, default=1, help='run the commands this many times')
+    parser.add_argument('--socket', help=f'control socket path (default: {CONTROL_SOCKET})')
+    args = parser.parse_args()
+
+    commands = read_commands(args.file) if args.file else []
+    if args.command:
+        commands.append(' '.join(args.command))
+    if not commands:
+        parser.error('no commands given')
+    commands *= args.repeat
+
+    started = time.perf_counter()
+    try:
+        replies = send_commands(commands, args.socket or control_path())
+    except (FileNotFoundError, ConnectionRefusedError):
+        sys.exit('No node running, start one with host.py start')
+    elapsed = time.perf_counter() - started
+
+    errors = [(command, reply) for command, reply in zip(commands, replies) if reply != 'ok']
+    for command, reply in errors:
+        print(f'{command}: {reply}', file=sys.stderr)
+    if len(commands) > 1:
+        print(f'{len(commands)} commands in {elapsed * 1e3:.1f}ms, {len(errors)} failed')
+    sys.exit(1 if errors else 0)
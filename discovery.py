@@ -0,0 +1,76 @@
+import fcntl
+import socket
+import struct
+from functools import lru_cache
+# c-spell: ignore ioctl SIOCGIFADDR ntoa
+
+# Reads the node's address and its neighbors straight from the kernel instead of running `ip`.
+# topo.py "connects" two nodes with a valid ARP entry and "disconnects" them with an all-zero MAC,
+# so the neighbors are the 10.0.0.x entries of the ARP table with a real MAC.
+
+ARP_TABLE = '/proc/net/arp'
+SIOCGIFADDR = 0x8915
+NETWORK = '10.0.0.'
+NO_MAC = '00:00:00:00:00:00'
+
+
+def interface_addresses():
+    """(interface, IPv4 address) of every interface that has one"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        for _, name in socket.if_nameindex():
+            try:
+                request = fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack('256s', name.encode()[:15]))
+            except OSError:
+                continue
+            yield name, socket.inet_ntoa(request[20:24])
+
+@lru_cache(maxsize=1)
+def get_my_ip():
+    ip = next((ip for _, ip in interface_addresses() if ip.startswith('10.')), '')
+    assert ip.startswith(NETWORK)
+    return ip
+
+def read_neighbors(path=ARP_TABLE):
+    ips = []
+    with open(path) as f:
+        next(f) # header
+        for line in f:
+            ip, _, _, mac, *_ = line.split()
+            if not ip.startswith(NETWORK) or mac == NO_MAC:
+                continue
+            if ip.endswith('255'): # skip monitor node
+                continue
+            ips.append(ip)
+    return ips
+
+@lru_cache(maxsize=1)
+def cached_neighbors():
+    return tuple(read_neighbors())
+
+def get_neighbors():
+    """Neighbors as of the first call, the ARP table is only read once per process"""
+    return list(cached_neighbors())
+
+def neighbor_changes(known, path=ARP_TABLE):
+    """(added, removed) neighbors between known and the ARP table right now. Reading
+    /proc/net/arp costs a few microseconds, so long running nodes can poll this often."""
+    current = read_neighbors(path)
+    known = set(known)
+    return [ip for ip in current if ip not in known], sorted(known.difference(current))
+
+
+if __name__ == '__main__':
+    import tempfile
+    print('Running tests')
+    with tempfile.NamedTemporaryFile('w', suffix='arp') as arp:
+        arp.write('IP address       HW type     Flags       HW address            Mask     Device\n'
+                  '10.0.0.2         0x1         0x6         00:00:00:00:00:02     *        h1-eth0\n'
+                  '10.0.0.3         0x1         0x6         00:00:00:00:00:00     *        h1-eth0\n'
+                  '10.0.0.255       0x1         0x6         00:00:00:00:00:ff     *        h1-eth0\n'
+                  '192.168.0.1      0x1         0x2         02:fc:00:00:00:05     *        eth0\n'
+                  '10.0.0.101       0x1         0x6         00:00:00:00:00:65     *        h1-eth0\n')
+        arp.flush()
+        assert read_neighbors(arp.name) == ['10.0.0.2', '10.0.0.101']
+        assert neighbor_changes(['10.0.0.101', '10.0.0.3'], arp.name) == (['10.0.0.2'], ['10.0.0.3'])
+        assert neighbor_changes(['10.0.0.2', '10.0.0.101'], arp.name) == ([], [])
+    assert ('lo', '127.0.0.1') in list(interface_addresses())
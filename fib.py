@@ -0,0 +1,557 @@
+import socket
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from collections.abc import ItemsView, Mapping, MutableMapping, ValuesView
+from functools import lru_cache
+from itertools import chain, starmap
+# c-spell: ignore aton ntoa
+
+# Forwarding table keys are either a host IP ('10.0.0.3') or a prefix ('10.0.0.0/30').
+
+
+@lru_cache(maxsize=1 << 16)
+def parse_prefix(key):
+    """(network as int, length) for a host IP or prefix key, or None if key is neither"""
+    ip, _, length = key.partition('/')
+    try:
+        network = int.from_bytes(socket.inet_aton(ip), 'big')
+    except OSError:
+        return None
+    if ip.count('.') != 3:
+        return None
+    length = int(length) if length else 32
+    if not 0 <= length <= 32:
+        return None
+    return network & mask(length), length
+
+def format_prefix(network, length):
+    ip = socket.inet_ntoa(network.to_bytes(4, 'big'))
+    return ip if length == 32 else f'{ip}/{length}'
+
+@lru_cache(maxsize=1 << 16)
+def format_ip(ip):
+    return socket.inet_ntoa(ip.to_bytes(4, 'big'))
+
+@lru_cache(maxsize=1 << 16)
+def table_key(key):
+    """How ForwardingTable stores key: the IP as an int for a host IP, (network, length) for a prefix,
+    None for anything else, including prefixes not written the way format_prefix writes them"""
+    parsed = parse_prefix(key) if isinstance(key, str) else None
+    if parsed is None:
+        return None
+    if '/' not in key:
+        return parsed[0]
+    return parsed if format_prefix(*parsed) == key and parsed[1] < 32 else None
+
+def ip_to_int(ip):
+    return int.from_bytes(socket.inet_aton(ip), 'big')
+
+def mask(length):
+    return (0xffffffff << (32 - length)) & 0xffffffff
+
+def common_length(a, b, max_length):
+    diff = a ^ b
+    return min(32 - diff.bit_length(), max_length)
+
+
+class TrieNode:
+    __slots__ = ('network', 'length', 'value', 'children')
+
+    def __init__(self, network, length, value=None):
+        self.network = network
+        self.length = length
+        self.value = value
+        self.children = [None, None]
+
+    def bit(self, network):
+        """Which child network belongs under"""
+        return (network >> (31 - self.length)) & 1
+
+
+class PrefixTrie:
+    """Path compressed binary (Patricia) trie over IPv4 prefixes for longest prefix match.
+    Nodes without a value only exist where two branches split."""
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    @classmethod
+    def from_table(cls, table, prefixes_only=False):
+        trie = cls()
+        for key, entry in table.items():
+            if prefixes_only and '/' not in key: continue
+            parsed = parse_prefix(key)
+            if parsed is not None:
+                trie.insert(*parsed, entry)
+        return trie
+
+    def insert(self, network, length, value):
+        network &= mask(length)
+        parent, node = None, self.root
+        while node is not None:
+            common = common_length(network, node.network, min(length, node.length))
+            if common < node.length:
+                break
+            if node.length == length:
+                if node.value is None:
+                    self.size += 1
+                node.value = value
+                return
+            parent, node = node, node.children[node.bit(network)]
+
+        new = TrieNode(network, length, value)
+        self.size += 1
+        if node is not None:
+            if common == length:
+                new.children[new.bit(node.network)] = node
+            else:
+                glue = TrieNode(network & mask(common), common)
+                glue.children[glue.bit(network)] = new
+                glue.children[glue.bit(node.network)] = node
+                new = glue
+        if parent is None:
+            self.root = new
+        else:
+            parent.children[parent.bit(network)] = new
+
+    def remove(self, network, length):
+        network &= mask(length)
+        grandparent, parent, node = None, None, self.root
+        while node is not None and node.length < length:
+            if (network ^ node.network) & mask(node.length):
+                return False
+            grandparent, parent, node = parent, node, node.children[node.bit(network)]
+        if node is None or node.length != length or node.network != network or node.value is None:
+            return False
+        node.value = None
+        self.size -= 1
+        # drop nodes that no longer carry a value or separate two branches
+        children = [child for child in node.children if child is not None]
+        if len(children) < 2:
+            self.replace(parent, node, children[0] if children else None)
+            if parent is not None and parent.value is None:
+                siblings = [child for child in parent.children if child is not None]
+                if len(siblings) < 2:
+                    self.replace(grandparent, parent, siblings[0] if siblings else None)
+        return True
+
+    def replace(self, parent, node, new):
+        if parent is None:
+            self.root = new
+        else:
+            parent.children[parent.children.index(node)] = new
+
+    def lookup(self, ip):
+        """Value of the longest prefix containing ip (an int), or None"""
+        node, best = self.root, None
+        while node is not None:
+            if node.length and (ip ^ node.network) >> (32 - node.length):
+                break
+            if node.value is not None:
+                best = node.value
+            if node.length == 32:
+                break
+            node = node.children[(ip >> (31 - node.length)) & 1]
+        return best
+
+    def items(self):
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            if node.value is not None:
+                yield format_prefix(node.network, node.length), node.value
+            stack.extend(child for child in node.children if child is not None)
+
+    def __len__(self):
+        return self.size
+
+
+MISSING = object()
+# host IPs whose entry get() and route() keep as a tuple, so the destinations packets go to are a dict
+# hit; either cache starts over when it is full
+ROUTE_CACHE_SIZE = 2048
+
+class ForwardingTable(MutableMapping):
+    """{ dst: (next_hop, cost) } with the host routes packed: sorted 4 byte IPs, a 2 byte index into
+    the distinct next hops, and 4 byte costs, so a route takes 10 bytes instead of a dict slot, a key
+    string and a tuple. A lookup is a bisect over the IPs, in front of which the last ROUTE_CACHE_SIZE
+    hosts looked up are kept in a dict, emptied of a host whenever its route changes. Prefix routes
+    live in a dict by (network, length), and route() does the longest prefix match over the prefix
+    lengths in use, with nothing to rebuild when the table changes. Keys that aren't IPs or prefixes,
+    and values that don't pack, are kept in a plain dict. Iterates hosts in address order, then
+    prefixes, then the rest, and values always come back as tuples."""
+    __slots__ = ('ips', 'hops', 'costs', 'next_hops', 'hop_index', 'prefixes', 'lengths', 'other', 'cache', 'routes')
+
+    def __init__(self, table=()):
+        # { host IP: entry } of get() and of route(), which also depends on the prefixes
+        self.cache = {}
+        self.routes = {}
+        self.ips = array('I')
+        self.hops = array('H')
+        self.costs = array('I')
+        self.next_hops = []
+        self.hop_index = {}
+        self.prefixes = {}
+        self.lengths = Counter()
+        self.other = {}
+        items = table.items() if isinstance(table, Mapping) else table
+        routes = []
+        for dst, entry in items:
+            key = table_key(dst)
+            if isinstance(key, int) and self.packs(entry):
+                routes.append((key, entry))
+            else:
+                self[dst] = entry
+        # sorting once beats inserting one by one
+        routes = dict(routes)
+        for ip in sorted(routes):
+            next_hop, cost = routes[ip]
+            self.ips.append(ip)
+            self.hops.append(self.hop(next_hop))
+            self.costs.append(cost)
+
+    def __getstate__(self):
+        return { name: getattr(self, name) for name in self.__slots__ if name not in ('cache', 'routes') }
+
+    def __setstate__(self, state):
+        self.cache = {}
+        self.routes = {}
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def packs(self, entry):
+        if not isinstance(entry, (tuple, list)) or len(entry) != 2: return False
+        next_hop, cost = entry
+        return type(cost) is int and 0 <= cost <= 0xffffffff and isinstance(next_hop, str) and (next_hop in self.hop_index or len(self.next_hops) <= 0xffff)
+
+    def hop(self, next_hop):
+        index = self.hop_index.get(next_hop)
+        if index is None:
+            index = self.hop_index[next_hop] = len(self.next_hops)
+            self.next_hops.append(next_hop)
+        return index
+
+    def find(self, ip):
+        """Index of ip among the hosts, or -1"""
+        i = bisect_left(self.ips, ip)
+        return i if i < len(self.ips) and self.ips[i] == ip else -1
+
+    def __getitem__(self, dst):
+        entry = self.get(dst, MISSING)
+        if entry is MISSING:
+            raise KeyError(dst)
+        return entry
+
+    def get(self, dst, default=None):
+        entry = self.cache.get(dst)
+        if entry is None:
+            key = table_key(dst)
+            entry = self.lookup(dst, key)
+            if key.__class__ is int:
+                # misses too, routers look up a few hosts they have no route to (their own IP) all the time
+                self.remember(self.cache, key, dst, entry)
+        return default if entry is MISSING else entry
+
+    def lookup(self, dst, key):
+        """Entry of dst, whose table_key is key, without the caches, or MISSING"""
+        if key.__class__ is int:
+            ips = self.ips
+            i = bisect_left(ips, key)
+            if i < len(ips) and ips[i] == key:
+                return (self.next_hops[self.hops[i]], self.costs[i])
+        elif key is not None and key in self.prefixes:
+            return self.prefixes[key]
+        return self.other.get(dst, MISSING) if self.other else MISSING
+
+    def __contains__(self, dst):
+        return self.get(dst, MISSING) is not MISSING
+
+    @staticmethod
+    def remember(cache, key, dst, entry):
+        # only under the one way to write the IP, which is what forget() removes
+        if format_ip(key) == dst:
+            if len(cache) >= ROUTE_CACHE_SIZE:
+                cache.clear()
+            cache[dst] = entry
+
+    def forget(self, key):
+        """Drops what the caches know about the route to key (table_key) before it changes"""
+        if key.__class__ is int:
+            dst = format_ip(key)
+            self.cache.pop(dst, None)
+            self.routes.pop(dst, None)
+        elif key is not None:
+            # longest prefix matches of any host may change
+            self.routes.clear()
+
+    def __setitem__(self, dst, entry):
+        key = table_key(dst)
+        if key.__class__ is int and self.packs(entry):
+            next_hop, cost = entry
+            hop = self.hop_index.get(next_hop)
+            if hop is None:
+                hop = self.hop(next_hop)
+            ips = self.ips
+            i = bisect_left(ips, key)
+            if i < len(ips) and ips[i] == key:
+                self.hops[i] = hop
+                self.costs[i] = cost
+            else:
+                ips.insert(i, key)
+                self.hops.insert(i, hop)
+                self.costs.insert(i, cost)
+            if self.other:
+                self.other.pop(dst, None)
+            # instead of forget(), the caches get the new entry, as a route that was just set tends
+            # to be looked up next
+            entry = (next_hop, cost)
+            dst = format_ip(key)
+            for cache in (self.cache, self.routes):
+                if dst in cache or len(cache) < ROUTE_CACHE_SIZE:
+                    cache[dst] = entry
+            return
+        self.forget(key)
+        if key is not None and self.packs(entry):
+            # a prefix, host routes took the path above
+            if key not in self.prefixes:
+                self.lengths[key[1]] += 1
+            self.prefixes[key] = tuple(entry)
+            self.other.pop(dst, None)
+            return
+        if dst in self:
+            del self[dst]
+        # the check above may have cached that there is no entry
+        self.forget(key)
+        self.other[dst] = tuple(entry) if type(entry) is list else entry
+
+    def __delitem__(self, dst):
+        key = table_key(dst)
+        self.forget(key)
+        if isinstance(key, int):
+            i = self.find(key)
+            if i >= 0:
+                del self.ips[i]
+                del self.hops[i]
+                del self.costs[i]
+                return
+        elif key is not None and key in self.prefixes:
+            del self.prefixes[key]
+            self.lengths[key[1]] -= 1
+            if not self.lengths[key[1]]:
+                del self.lengths[key[1]]
+            return
+        del self.other[dst]
+
+    def __len__(self):
+        return len(self.ips) + len(self.prefixes) + len(self.other)
+
+    def __iter__(self):
+        return chain(map(format_ip, self.ips), starmap(format_prefix, self.prefixes), self.other)
+
+    def values(self):
+        return ForwardingTableValues(self)
+
+    def items(self):
+        return ForwardingTableItems(self)
+
+    def iter_values(self):
+        # zip builds the (next_hop, cost) tuples
+        return chain(zip(map(self.next_hops.__getitem__, self.hops), self.costs), self.prefixes.values(), self.other.values())
+
+    def clear(self):
+        self.__init__()
+
+    def copy(self):
+        table = ForwardingTable()
+        table.ips, table.hops, table.costs = array('I', self.ips), array('H', self.hops), array('I', self.costs)
+        table.next_hops, table.hop_index = list(self.next_hops), dict(self.hop_index)
+        table.prefixes, table.lengths, table.other = dict(self.prefixes), Counter(self.lengths), dict(self.other)
+        return table
+
+    def __eq__(self, other):
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        return len(self) == len(other) and all(other.get(dst, None) == entry for dst, entry in self.items())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def route(self, dst):
+        """Entry of dst, or of the longest prefix containing it, or None"""
+        entry = self.routes.get(dst)
+        if entry is not None:
+            return entry
+        ip = table_key(dst)
+        entry = self.lookup(dst, ip)
+        if ip.__class__ is not int:
+            return None if entry is MISSING else entry
+        if entry is MISSING:
+            for length in sorted(self.lengths, reverse=True):
+                entry = self.prefixes.get((ip & mask(length), length))
+                if entry is not None:
+                    break
+            else:
+                return None
+        self.remember(self.routes, ip, dst, entry)
+        return entry
+
+
+class ForwardingTableValues(ValuesView):
+    """values() of a ForwardingTable, iterated straight from its arrays"""
+    __slots__ = ()
+
+    def __iter__(self):
+        return self._mapping.iter_values()
+
+
+class ForwardingTableItems(ItemsView):
+    """items() of a ForwardingTable, iterated straight from its arrays"""
+    __slots__ = ()
+
+    def __iter__(self):
+        return zip(self._mapping, self._mapping.iter_values())
+
+
+def aggregate(table):
+    """Replaces groups of host routes with the same (next_hop, cost) by the fewest prefixes that
+    cover exactly those hosts. Routes that aren't host IPs are kept as they are."""
+    result = {}
+    groups = {}
+    for dst, (next_hop, cost) in table.items():
+        parsed = parse_prefix(dst) if '/' not in dst else None
+        if parsed is None:
+            result[dst] = (next_hop, cost)
+        else:
+            groups.setdefault((next_hop, cost), set()).add(parsed[0])
+
+    for entry, networks in groups.items():
+        length = 32
+        while networks:
+            if length == 0:
+                result[format_prefix(0, 0)] = entry
+                break
+            step = 1 << (32 - length)
+            merged = { network for network in networks if network & step == 0 and network | step in networks }
+            for network in networks:
+                if network & ~step not in merged:
+                    result[format_prefix(network, length)] = entry
+            networks = merged
+            length -= 1
+
+    return result
+
+def summarize(costs):
+    """{ dst: cost } with the host IPs merged into the fewest prefixes that cover exactly the same
+    hosts, each with the largest cost among the hosts it covers. Other keys are kept as they are."""
+    result = {}
+    trie = PrefixTrie()
+    for key in aggregate({ dst: (None, 0) for dst in costs }):
+        if key in costs:
+            result[key] = costs[key]
+        else:
+            trie.insert(*parse_prefix(key), key)
+    for dst, cost in costs.items():
+        if dst in result: continue
+        prefix = trie.lookup(parse_prefix(dst)[0])
+        result[prefix] = max(result.get(prefix, 0), cost)
+    return result
+
+
+if __name__ == '__main__':
+    print('Running tests')
+    table = { f'10.0.0.{i}': ('10.0.0.101', 2) for i in range(8, 16) }
+    table['10.0.0.5'] = ('10.0.0.101', 2)
+    table['10.0.0.16'] = ('10.0.0.102', 2)
+    table['10.0.0.17'] = ('10.0.0.102', 2)
+    table['10.0.0.18'] = ('10.0.0.102', 3)
+    table['10.0.0.101'] = ('10.0.0.101', 1)
+    table['h1'] = ('10.0.0.101', 2)
+    assert aggregate(table) == {
+        '10.0.0.8/29': ('10.0.0.101', 2),
+        '10.0.0.5': ('10.0.0.101', 2),
+        '10.0.0.16/31': ('10.0.0.102', 2),
+        '10.0.0.18': ('10.0.0.102', 3),
+        '10.0.0.101': ('10.0.0.101', 1),
+        'h1': ('10.0.0.101', 2),
+    }
+
+    costs = { f'10.0.0.{i}': i % 3 + 1 for i in range(8, 16) }
+    costs.update({ '10.0.0.5': 1, '10.0.0.16/30': 4, 'h1': 2 })
+    assert summarize(costs) == { '10.0.0.8/29': 3, '10.0.0.5': 1, '10.0.0.16/30': 4, 'h1': 2 }
+
+    trie = PrefixTrie.from_table(aggregate(table))
+    for dst, (next_hop, cost) in table.items():
+        if dst != 'h1':
+            assert trie.lookup(ip_to_int(dst)) == (next_hop, cost)
+    assert trie.lookup(ip_to_int('10.0.0.200')) is None
+    trie.insert(*parse_prefix('10.0.0.0/24'), 'default')
+    trie.insert(*parse_prefix('0.0.0.0/0'), 'everything')
+    assert trie.lookup(ip_to_int('10.0.0.200')) == 'default'
+    assert trie.lookup(ip_to_int('10.0.0.12')) == ('10.0.0.101', 2)
+    assert trie.lookup(ip_to_int('11.0.0.1')) == 'everything'
+    assert trie.remove(*parse_prefix('10.0.0.8/29'))
+    assert not trie.remove(*parse_prefix('10.0.0.8/29'))
+    assert trie.lookup(ip_to_int('10.0.0.12')) == 'default'
+    assert len(trie) == len(dict(trie.items())) == 6
+
+    import random
+    rng = random.Random(358)
+    routes = {}
+    trie = PrefixTrie()
+    for _ in range(2000):
+        network, length = rng.getrandbits(32), rng.choice([0, 8, 16, 20, 24, 28, 30, 32])
+        key = (network & mask(length), length)
+        if key in routes and rng.random() < 0.5:
+            del routes[key]
+            assert trie.remove(*key)
+        else:
+            routes[key] = rng.random()
+            trie.insert(*key, routes[key])
+        ip = rng.choice([rng.getrandbits(32), network])
+        matches = [(length, value) for (network, length), value in routes.items() if (ip ^ network) & mask(length) == 0]
+        assert trie.lookup(ip) == (max(matches)[1] if matches else None)
+
+    # the packed table behaves like the dict it stands in for
+    import pickle
+    expected = {}
+    table = ForwardingTable()
+    keys = [f'10.0.{rng.randrange(4)}.{rng.randrange(256)}' for _ in range(300)] + ['10.0.1.0/24', '10.0.0.0/16', '10.0.1.128/25', 'h1', '10.0.1.1/24']
+    for _ in range(3000):
+        dst = rng.choice(keys)
+        if dst in expected and rng.random() < 0.3:
+            del expected[dst]
+            del table[dst]
+        else:
+            entry = (f'10.0.0.{rng.randrange(101, 105)}', rng.randrange(1, 20))
+            if rng.random() < 0.1:
+                entry = list(entry)
+            table[dst] = entry
+            expected[dst] = tuple(entry)
+        assert len(table) == len(expected) and dst in table or dst not in expected
+        # fills the caches, which every change has to keep right
+        probe = rng.choice(keys)
+        assert table.get(probe) == expected.get(probe)
+        table.route(probe)
+    assert table == expected and dict(table) == expected and table.copy() == expected
+    assert pickle.loads(pickle.dumps(table)) == expected
+    assert ForwardingTable(expected) == expected
+    assert table.get('10.0.9.9') is None and '10.0.9.9' not in table
+    # a prefix not written the way format_prefix writes it is only an exact key
+    trie = PrefixTrie.from_table({ dst: entry for dst, entry in expected.items() if dst != '10.0.1.1/24' }, prefixes_only=True)
+    for dst in keys[:300] + ['10.0.1.200', '10.0.2.7', '10.1.0.1']:
+        assert table.route(dst) == (expected.get(dst) or trie.lookup(ip_to_int(dst)))
+    assert table.route('h1') == expected.get('h1') and table.route('h2') is None
+    # the same host written another way changes the cached entry too
+    table['10.0.3.5'] = ('10.0.0.101', 1)
+    assert table.get('10.0.3.5') == table.route('10.0.3.5') == ('10.0.0.101', 1)
+    table['10.0.3.05'] = ('10.0.0.102', 2)
+    assert table.get('10.0.3.5') == table.route('10.0.3.5') == ('10.0.0.102', 2)
+    del table['10.0.3.05']
+    assert table.get('10.0.3.5') is None and table.route('10.0.3.5') == trie.lookup(ip_to_int('10.0.3.5'))
+    assert list(table.keys()) == list(table) and len(table.items()) == len(table) and ('h1', expected.get('h1')) in table.items() or 'h1' not in expected
+    table['10.0.0.1'] = ('10.0.0.101', 'not a cost')
+    assert table['10.0.0.1'] == ('10.0.0.101', 'not a cost')
+    table['10.0.0.1'] = ('10.0.0.101', 3)
+    assert table['10.0.0.1'] == ('10.0.0.101', 3) and len(table.other) == (1 if 'h1' in expected else 0) + ('10.0.1.1/24' in expected)
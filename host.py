@@ -1,14 +1,25 @@
 #!/usr/bin/python
 # c-spell: ignore ospf inet dgram sendto
 
+import asyncio
+import multiprocessing
+import os
+import pickle
 import socket
-from socketserver import UDPServer, BaseRequestHandler
-import subprocess
+import struct
+import time
+import zlib
 from sys import argv
-import json
 import logging
-from log_helper import ColorLogFormatter
-from algo import ospf_algo, rip_new_table
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from control import control_path, send_commands
+from discovery import get_my_ip, get_neighbors, neighbor_changes
+from log_helper import ColorLogFormatter, FlightRecorderHandler, Tracer, parse_sample
+from wire import encode, decode
+from algo import ospf_algo, rip_merge, link_state_spf, OspfEngine, ADDED, REMOVED, NEXT_HOP_CHANGED, PATHS_CHANGED, INFINITY
+from fib import ForwardingTable, aggregate, summarize
+from stats import Stats, format_report
 
 console = logging.StreamHandler()
 console.setLevel(logging.DEBUG)
@@ -18,22 +29,384 @@ logging.getLogger('').addHandler(console)
 logger = logging.getLogger('main')
 logger.setLevel(logging.DEBUG)
 
+# structured events, off unless started with TRACE=<directory> (see __main__)
+tracer = Tracer()
+
 PORT = 1111
 
+RIP_HOLD_DOWN = 0.02
+RIP_MIN_INTERVAL = 0.1
+
+SEND_QUEUE_LIMIT = 256
+
+# tables that don't fit in one datagram of this size (one Ethernet frame) are sent in chunks
+MAX_DATAGRAM = 1400
+# missing chunks are asked for again every CHUNK_RETRY seconds, up to CHUNK_RETRIES times
+CHUNK_RETRY = 0.1
+CHUNK_RETRIES = 3
+# keys of the messages that carry a forwarding table or something shaped like one
+TABLE_KEYS = ('rip-update', 'table', 'lsa', 'lsa-ack')
+# of those, the ones handled chunk by chunk instead of after reassembly
+STREAM_KEYS = ('rip-update', 'lsa', 'lsa-ack')
+
+# nodes that discovered their own neighbors check the ARP table for changes this often
+NEIGHBOR_POLL = 1.0
+
+# routers remember the last BROADCAST_CACHE_SIZE broadcasts they flooded for BROADCAST_CACHE_TTL seconds
+# and drop further copies of them; with BROADCAST_RPF=1 they also drop copies that didn't come in over
+# their own route back to the origin (reverse path forwarding)
+BROADCAST_CACHE_SIZE = 4096
+BROADCAST_CACHE_TTL = 5.0
+BROADCAST_RPF = os.environ.get('BROADCAST_RPF') == '1'
+
+# hosts and routers say hello to their neighbors every HELLO_INTERVAL seconds, a neighbor that
+# hasn't been heard from for DEAD_INTERVAL seconds is considered down
+HELLO_INTERVAL = float(os.environ.get('HELLO_INTERVAL', 0.1))
+DEAD_INTERVAL = float(os.environ.get('DEAD_INTERVAL', 4 * HELLO_INTERVAL))
+
+# routes keep up to ECMP_PATHS equal cost next hops, a hash of (src, dst) picks one per flow
+ECMP_PATHS = int(os.environ.get('ECMP_PATHS', 4))
+
+# topology changes reported to the monitor within this window share one OSPF round
+TOPOLOGY_HOLD_DOWN = 0.02
+
+# how long the monitor waits for get-stats replies before reporting what it has
+STATS_TIMEOUT = 1.0
+
+# an OSPF round asks again every OSPF_RETRANSMIT seconds and gives up on missing tables after OSPF_DEADLINE
+OSPF_RETRANSMIT = 0.25
+OSPF_DEADLINE = 1.0
+
+# in link-state mode, unacked LSAs are sent again every LSA_RETRANSMIT seconds; link changes within
+# LSA_HOLD_DOWN go out as one LSA, and LSAs arriving within SPF_HOLD_DOWN share one SPF run
+LSA_RETRANSMIT = 0.1
+LSA_HOLD_DOWN = 0.02
+SPF_HOLD_DOWN = 0.01
+# link-state areas of this router, e.g. AREAS=0,1 for a border router; area 0 is the backbone
+BACKBONE = 0
+AREAS = tuple(int(area) for area in os.environ.get('AREAS', str(BACKBONE)).split(','))
+
+# datagrams a forwarding worker hands to its control plane are dropped while more than WORKER_BACKLOG
+# bytes of them are still waiting to be written
+WORKER_BACKLOG = 4 * 1024 * 1024
+
 monitor_ip = '10.0.0.255'
 
-def encode(data):
-    return bytes(json.dumps(data), 'utf-8')
+class Sender:
+    """Owns the socket all datagrams go out of and one outbound queue per neighbor.
+    A running node attaches its own datagram transport and the queues are flushed in one batch
+    per event loop iteration; without a node (CLI commands) every datagram is sent right away."""
+
+    def __init__(self, queue_limit=SEND_QUEUE_LIMIT):
+        self.socket = None
+        self.transport = None
+        self.loop = None
+        self.flush_scheduled = False
+        self.paused = False
+        self.queue_limit = queue_limit
+        self.queues = {}
+        self.dropped = 0
+
+    def attach(self, transport, loop):
+        self.transport = transport
+        self.loop = loop
+
+    def enqueue(self, neighbor, payload):
+        queue = self.queues.get(neighbor)
+        if queue is None:
+            queue = self.queues[neighbor] = deque()
+        if len(queue) >= self.queue_limit:
+            self.flush_queue(neighbor, queue)
+            if len(queue) >= self.queue_limit:
+                queue.popleft()
+                self.dropped += 1
+                logger.warning('Send queue to %s is full, dropped oldest datagram (%s so far)', neighbor, self.dropped)
+        queue.append(payload)
+        if self.transport is None:
+            self.flush_queue(neighbor, queue)
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        for neighbor, queue in self.queues.items():
+            if queue:
+                self.flush_queue(neighbor, queue)
+
+    def flush_queue(self, neighbor, queue):
+        if self.paused:
+            return # the transport buffer is over its high-water mark, resume_writing flushes again
+        if self.transport is not None:
+            sendto = self.transport.sendto
+        else:
+            if self.socket is None:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sendto = self.socket.sendto
+        address = (neighbor, PORT)
+        while queue and not self.paused:
+            sendto(queue.popleft(), address)
+
+
+class Channel:
+    """Pickled messages over one end of a socket pair between a router and its forwarding worker,
+    without ever blocking the event loop: messages are written as fast as the socket takes them and
+    the rest waits for it to become writable; received bytes are cut into messages as they arrive.
+    send_latest() is for messages where only the newest counts: one still waiting is replaced, and
+    it is only pickled once everything before it has been written."""
+    header = struct.Struct('!I')
+
+    def __init__(self, sock, loop, receive):
+        sock.setblocking(False)
+        self.sock = sock
+        self.loop = loop
+        self.receive = receive
+        self.incoming = bytearray()
+        self.outgoing = bytearray()
+        self.latest = None
+        self.writing = False
+        loop.add_reader(sock.fileno(), self.read)
+
+    @property
+    def backlog(self):
+        return len(self.outgoing)
+
+    def frame(self, message):
+        payload = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        self.outgoing += self.header.pack(len(payload))
+        self.outgoing += payload
+
+    def send(self, message):
+        self.frame(message)
+        self.write()
+
+    def send_latest(self, message):
+        self.latest = message
+        self.write()
+
+    def write(self):
+        while True:
+            if not self.outgoing and self.latest is not None:
+                message, self.latest = self.latest, None
+                self.frame(message)
+            if not self.outgoing:
+                break
+            try:
+                sent = self.sock.send(self.outgoing)
+            except (BlockingIOError, InterruptedError):
+                break
+            del self.outgoing[:sent]
+        waiting = bool(self.outgoing)
+        if waiting != self.writing:
+            self.writing = waiting
+            if waiting:
+                self.loop.add_writer(self.sock.fileno(), self.write)
+            else:
+                self.loop.remove_writer(self.sock.fileno())
+
+    def read(self):
+        try:
+            data = self.sock.recv(1 << 16)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not data:
+            logger.error('Channel closed by the other side')
+            self.loop.remove_reader(self.sock.fileno())
+            return
+        self.incoming += data
+        size = self.header.size
+        while len(self.incoming) >= size:
+            length, = self.header.unpack_from(self.incoming)
+            if len(self.incoming) < size + length:
+                break
+            message = pickle.loads(memoryview(self.incoming)[size:size + length])
+            del self.incoming[:size + length]
+            self.receive(message)
+
+
+class Reassembly:
+    __slots__ = ('message', 'chunks', 'parts', 'tries', 'done')
+
+    def __init__(self, message):
+        self.message = message
+        self.chunks = message['chunks']
+        self.parts = {}
+        self.tries = 0
+        self.done = False
+
+
+class Transfers:
+    """Splits messages whose table doesn't fit in a datagram into chunks and puts them back together.
+    Every chunk is a complete message with a slice of the table, the 'paths' of that slice if the
+    message has any, and 'transfer', 'chunk' and 'chunks'.
+    RIP updates and LSAs are handed on chunk by chunk so they are used as they arrive; other tables
+    are reassembled first. Receivers ask for missing chunks by index every CHUNK_RETRY seconds, and
+    give up (node.transfer_lost) after CHUNK_RETRIES tries."""
+
+    def __init__(self, node):
+        self.node = node
+        self.next_id = 0
+        self.sent = {}
+        self.incoming = {}
+
+    def split(self, data, size):
+        """Encoded chunks of data, whose encoding is size bytes; [] if it has no table to split"""
+        key = next((key for key in TABLE_KEYS if isinstance(data.get(key), Mapping)), None)
+        if key is None:
+            return []
+        routes = list(data[key].items())
+        self.next_id += 1
+        header = len(encode({ **data, key: {}, **self.paths_of(data, {}), 'transfer': self.next_id, 'chunk': 0, 'chunks': 0 }))
+        per_chunk = max(1, len(routes) * (MAX_DATAGRAM - header) // max(size - header, 1))
+        while True:
+            slices = [dict(routes[i:i + per_chunk]) for i in range(0, len(routes), per_chunk)]
+            payloads = [encode({ **data, key: part, **self.paths_of(data, part), 'transfer': self.next_id, 'chunk': i, 'chunks': len(slices) }) for i, part in enumerate(slices)]
+            # route sizes vary (prefixes, distinct next hops), try again with smaller chunks
+            if per_chunk == 1 or max(map(len, payloads)) <= MAX_DATAGRAM:
+                break
+            per_chunk //= 2
+        if self.node.loop is not None:
+            # kept for as long as the receiver may ask for missing chunks
+            self.sent[self.next_id] = payloads
+            self.node.loop.call_later(CHUNK_RETRY * (CHUNK_RETRIES + 2), self.sent.pop, self.next_id, None)
+        return payloads
+
+    @staticmethod
+    def paths_of(data, part):
+        paths = data.get('paths')
+        if paths is None:
+            return {}
+        return { 'paths': { dst: paths[dst] for dst in part if dst in paths } }
+
+    def receive(self, message, src):
+        """The message to handle, or None if there is nothing to handle (yet)"""
+        if 'chunk-request' in message:
+            self.resend(message['chunk-request'], message['missing'], src)
+            return None
+        transfer = message.get('transfer')
+        if transfer is None:
+            return message
+        key = (src, transfer)
+        reassembly = self.incoming.get(key)
+        if reassembly is None:
+            reassembly = self.incoming[key] = Reassembly(message)
+            self.node.loop.call_later(CHUNK_RETRY, self.check, key)
+        index = message['chunk']
+        if reassembly.done or index in reassembly.parts:
+            return None
+        table_key = next(key for key in TABLE_KEYS if key in message)
+        stream = table_key in STREAM_KEYS
+        reassembly.parts[index] = None if stream else (message[table_key], message.get('paths'))
+        complete = len(reassembly.parts) == reassembly.chunks
+        reassembly.done = complete
+        if stream:
+            return message
+        if not complete:
+            return None
+        table = {}
+        paths = {}
+        for i in range(reassembly.chunks):
+            part, part_paths = reassembly.parts[i]
+            table.update(part)
+            paths.update(part_paths or {})
+        reassembly.parts = {}
+        message = { key: value for key, value in message.items() if key not in ('transfer', 'chunk', 'chunks') }
+        message[table_key] = table
+        if 'paths' in message:
+            message['paths'] = paths
+        return message
+
+    def check(self, key):
+        reassembly = self.incoming[key]
+        src, transfer = key
+        if reassembly.done:
+            del self.incoming[key]
+        elif reassembly.tries < CHUNK_RETRIES:
+            reassembly.tries += 1
+            missing = [i for i in range(reassembly.chunks) if i not in reassembly.parts]
+            logger.debug('Asking %s again for %s chunks of transfer %s', src, len(missing), transfer)
+            self.node.stats.count('chunk.requested', len(missing))
+            self.node.send(src, { 'chunk-request': transfer, 'missing': missing, 'src': self.node.my_ip })
+            self.node.loop.call_later(CHUNK_RETRY, self.check, key)
+        else:
+            del self.incoming[key]
+            logger.warning('Gave up on transfer %s from %s, got %s of %s chunks', transfer, src, len(reassembly.parts), reassembly.chunks)
+            self.node.stats.count('chunk.lost-transfers')
+            self.node.transfer_lost(reassembly.message, src)
+
+    def resend(self, transfer, missing, neighbor):
+        payloads = self.sent.get(transfer)
+        if payloads is None:
+            logger.warning('%s asked for transfer %s, which is no longer kept', neighbor, transfer)
+            return
+        for index in missing:
+            self.node.sender.enqueue(neighbor, payloads[index])
+
+class CommandError(Exception):
+    pass
+
+HOST_COMMANDS = ('broadcast', 'send')
+MONITOR_COMMANDS = ('print', 'br-all', 'trigger-ospf', 'trigger-rip', 'rip-on', 'rip-off', 'ls-on', 'ls-off', 'stats', 'clear')
+
+def run_command(node, args):
+    """Runs a CLI command (args without 'host.py') on node: the running node when it comes in over
+    the control socket, otherwise a Host or Monitor that only lives for this command"""
+    command = args[0]
+    if command in HOST_COMMANDS and not isinstance(node, (Host, Router)):
+        raise CommandError(f'{command} only works on hosts and routers')
+    if command in MONITOR_COMMANDS and not isinstance(node, Monitor):
+        raise CommandError(f'{command} only works on the monitor')
+
+    if command == 'broadcast':
+        node.broadcast(ttl=int(args[1]) if len(args) > 1 else 0)
+
+    elif command == 'send':
+        if len(args) < 2:
+            raise CommandError('send <dst> [ttl]')
+        if len(node.neighbors) != 1:
+            raise CommandError('send only works on hosts')
+        ttl = int(args[2]) if len(args) > 2 else 5
+        node.send(node.neighbors[0], { 'src': node.my_ip, 'dst': normalize_ip(args[1]), 'ttl': ttl })
+
+    elif command == 'print':
+        if len(args) < 2:
+            raise CommandError('print <router | all>')
+        if args[1] == 'all':
+            node.print_all_table()
+        else:
+            node.print_table(normalize_ip(args[1]))
+
+    elif command == 'br-all':
+        node.trigger_br_all()
+
+    elif command == 'trigger-ospf':
+        node.trigger_ospf()
+
+    elif command == 'trigger-rip':
+        if len(args) < 2:
+            raise CommandError('trigger-rip <router | all>')
+        node.trigger_rip(None if args[1] == 'all' else normalize_ip(args[1]))
+
+    elif command == 'rip-on':
+        node.rip_mode(True)
 
-def decode(data):
-    return json.loads(data.decode('utf-8'))
+    elif command == 'rip-off':
+        node.rip_mode(False)
 
-def send(neighbor, data):
-    logger.debug(f'Sending through {neighbor}: {data}')
-    if neighbor not in neighbors and neighbor != monitor_ip:
-        logger.critical(f'{neighbor} is not a neighbor')
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-        s.sendto(encode(data), (neighbor, PORT))
+    elif command == 'ls-on':
+        node.link_state_mode(True)
+
+    elif command == 'ls-off':
+        node.link_state_mode(False)
+
+    elif command == 'stats':
+        node.gather_stats()
+
+    elif command == 'clear':
+        node.clear_all_table(None if len(args) < 2 else normalize_ip(args[1]))
+
+    else:
+        raise CommandError(f'Unknown command: {command}')
 
 def normalize_ip(ip):
     """Allows user to input only the last part of the IP address"""
@@ -42,54 +415,293 @@ def normalize_ip(ip):
     return f'10.0.0.{ip}'
 
 
-def get_my_ip():
-    out = subprocess.run('ip addr | awk \'/inet 10/ { print $2 }\'', shell=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
-    ip = out.strip()
-    ip = ip.replace('/8', '')
-    assert ip.startswith('10.0.0.')
-    return ip
-my_ip = get_my_ip()
-
-def get_neighbors():
-    out = subprocess.run('ip neighbor', shell=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
-    ips = []
-    for line in out.strip().split('\n'):
-        if line.startswith('10.0.0.') and '00:00:00:00:00:00' not in line:
-            ip = line.split()[0]
-            if ip.endswith('255'): # skip monitor node
-                continue
-            ips.append(ip)
-    return ips
-neighbors = get_neighbors()
 
 
 
+class Liveness:
+    """Hellos to every neighbor, and neighbor_down / neighbor_up on the node when a neighbor goes
+    silent for dead_interval or is heard from again. Any datagram from a neighbor counts."""
 
+    def __init__(self, node, interval=HELLO_INTERVAL, dead_interval=DEAD_INTERVAL):
+        self.node = node
+        self.interval = interval
+        self.dead_interval = dead_interval
+        self.last_heard = {}
+        self.dead = set()
+        self.running = False
 
-class Host:
-    def __init__(self):
-        self.neighbors = neighbors
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        now = self.node.loop.time()
+        for neighbor in self.node.neighbors:
+            self.last_heard.setdefault(neighbor, now)
+        self.tick()
+        self.node.every(self.interval, self.tick)
+
+    def heard(self, neighbor):
+        if not self.running:
+            return
+        self.last_heard[neighbor] = self.node.loop.time()
+        if neighbor in self.dead:
+            self.dead.discard(neighbor)
+            logger.warning('Neighbor %s is up again', neighbor)
+            self.node.stats.count('neighbor.up')
+            tracer.event('neighbor-up', neighbor=neighbor)
+            self.node.neighbor_up(neighbor)
+
+    def tick(self):
+        now = self.node.loop.time()
+        for neighbor in self.node.neighbors:
+            self.node.send(neighbor, self.node.hello_message())
+            if neighbor not in self.dead and now - self.last_heard.setdefault(neighbor, now) > self.dead_interval:
+                self.dead.add(neighbor)
+                logger.warning('Neighbor %s is down, nothing heard for %.2fs', neighbor, now - self.last_heard[neighbor])
+                self.node.stats.count('neighbor.down')
+                tracer.event('neighbor-down', neighbor=neighbor)
+                self.node.neighbor_down(neighbor)
+
+    def forget(self, neighbor):
+        self.last_heard.pop(neighbor, None)
+        self.dead.discard(neighbor)
+
+
+class BroadcastFilter:
+    """Decides which broadcasts a router floods. A broadcast is numbered by its origin, and each
+    (origin, seq) is flooded once: pairs are kept in least recently seen order and forgotten after
+    ttl seconds, or when more than size of them are kept, so memory stays bounded under any load"""
+
+    def __init__(self, router, size=BROADCAST_CACHE_SIZE, ttl=BROADCAST_CACHE_TTL, rpf=BROADCAST_RPF):
+        self.router = router
+        self.size = size
+        self.ttl = ttl
+        self.rpf = rpf
+        self.seen = OrderedDict()
+
+    def check(self, src, seq, client_ip):
+        """None if the broadcast is to be flooded, otherwise the reason to drop it"""
+        if self.rpf and not self.on_reverse_path(src, client_ip):
+            return 'rpf'
+        if seq is None:
+            # from a node that doesn't number its broadcasts
+            return None
+        now = self.router.loop.time()
+        while self.seen:
+            oldest = next(iter(self.seen))
+            if now - self.seen[oldest] <= self.ttl:
+                break
+            del self.seen[oldest]
+        key = (src, seq)
+        if key in self.seen:
+            self.seen[key] = now
+            self.seen.move_to_end(key)
+            return 'duplicate'
+        self.seen[key] = now
+        if len(self.seen) > self.size:
+            self.seen.popitem(last=False)
+            self.router.stats.count('broadcast.evicted')
+        return None
+
+    def on_reverse_path(self, src, client_ip):
+        entry = self.router.forwarding_table.route(src)
+        # without a route back yet there is nothing to check against
+        return entry is None or entry[0] == client_ip or client_ip in self.router.paths.get(src, ())
+
+
+class NodeProtocol(asyncio.DatagramProtocol):
+    def __init__(self, node):
+        self.node = node
+
+    def connection_made(self, transport):
+        self.node.sender.attach(transport, self.node.loop)
+
+    def datagram_received(self, data, addr):
+        self.node.spawn(self.node.handler.handle(data, addr[0]), self.node.loop.time())
+
+    def error_received(self, exc):
+        logger.error('Socket error: %s', exc)
+
+    def pause_writing(self):
+        self.node.sender.paused = True
+
+    def resume_writing(self):
+        self.node.sender.paused = False
+        self.node.sender.flush()
+
+
+class Node:
+    """One asyncio event loop per node: datagrams, timers and periodic tasks all run on it"""
+    kind = 'node'
+
+    reuse_port = False
+    control = True
+    hello = False
+
+    def __init__(self, my_ip=None, neighbors=None):
+        self.my_ip = my_ip if my_ip is not None else get_my_ip()
+        self.neighbors = neighbors if neighbors is not None else get_neighbors()
+        self.watch_neighbors = neighbors is None
+        self.sender = Sender()
+        self.stats = Stats()
+        self.transfers = Transfers(self)
+        self.liveness = Liveness(self)
+        self.loop = None
+        self.handler = None
+        self.tasks = set()
+        # from the clock, so a restarted node or a one-shot 'host.py broadcast' doesn't reuse numbers routers still remember
+        self.broadcast_seq = int(time.time() * 1000)
+
+    def send(self, neighbor, data):
+        self.send_all((neighbor,), data)
+
+    def send_all(self, neighbors, data):
+        """Sends the same message to every one of neighbors, encoded only once"""
+        # hellos go out several times a second per neighbor and would drown everything else
+        if 'hello' not in data:
+            logger.debug('Sending through %s: %s', neighbors, data)
+        payload = encode(data)
+        payloads = (len(payload) > MAX_DATAGRAM and self.transfers.split(data, len(payload))) or (payload,)
+        for neighbor in neighbors:
+            if neighbor not in self.neighbors and neighbor != monitor_ip:
+                logger.critical('%s is not a neighbor', neighbor)
+            for payload in payloads:
+                self.stats.sent(neighbor, len(payload))
+                tracer.event('send', to=neighbor, size=len(payload))
+                self.sender.enqueue(neighbor, payload)
 
     def start_server(self):
-        self.server = UDPServer(server_address=('', PORT), RequestHandlerClass=HostHandler)
-        logger.info('Starting client server')
-        self.server.serve_forever()
+        logger.info('Starting %s server', self.kind)
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        transport, _ = await self.loop.create_datagram_endpoint(lambda: NodeProtocol(self), local_addr=('0.0.0.0', PORT), reuse_port=self.reuse_port)
+        control = await self.serve_control() if self.control else None
+        self.started()
+        if self.watch_neighbors:
+            self.every(NEIGHBOR_POLL, self.poll_neighbors)
+        if self.hello:
+            self.liveness.start()
+        try:
+            await self.loop.create_future()
+        finally:
+            transport.close()
+            if control is not None:
+                control.close()
+                os.unlink(control_path(self.my_ip))
+
+    async def serve_control(self):
+        """Listens for CLI commands (see control.py) on a Unix socket"""
+        path = control_path(self.my_ip)
+        if os.path.exists(path):
+            os.unlink(path) # left over from a node that didn't shut down cleanly
+        return await asyncio.start_unix_server(self.control_connection, path)
+
+    async def control_connection(self, reader, writer):
+        async for line in reader:
+            args = line.decode().split()
+            if not args: continue
+            try:
+                run_command(self, args)
+                reply = 'ok'
+            except (CommandError, ValueError) as e:
+                reply = f'error: {e}'
+            writer.write(f'{reply}\n'.encode())
+            await writer.drain()
+        writer.close()
+
+    def spawn(self, coroutine, received=None):
+        """Runs coroutine as a task; received is the loop time its datagram arrived at"""
+        task = self.loop.create_task(self.run_task(coroutine, received))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run_task(self, coroutine, received=None):
+        if received is not None:
+            self.stats.observe('handler-queue', self.loop.time() - received)
+        try:
+            await coroutine
+        except Exception:
+            logger.exception('Handler failed')
+
+    def started(self):
+        """Called on the event loop once the socket is bound"""
+
+    def poll_neighbors(self):
+        added, removed = neighbor_changes(self.neighbors)
+        if added or removed:
+            logger.info('Neighbors changed: added %s, removed %s', added, removed)
+            self.neighbors = [neighbor for neighbor in self.neighbors if neighbor not in removed] + added
+            self.neighbors_changed(added, removed)
+
+    def hello_message(self):
+        return { 'hello': True, 'src': self.my_ip }
+
+    def broadcast_message(self, ttl):
+        """A new broadcast from this node, numbered so routers flood it only once"""
+        self.broadcast_seq += 1
+        return { 'src': self.my_ip, 'dst': 'ALL', 'ttl': ttl, 'seq': self.broadcast_seq }
+
+    def neighbors_changed(self, added, removed):
+        """Called after self.neighbors was updated"""
+
+    def neighbor_down(self, neighbor):
+        """Called when neighbor stopped answering hellos"""
+
+    def neighbor_up(self, neighbor):
+        """Called when a neighbor that was down is heard from again"""
+
+    def transfer_lost(self, message, src):
+        """Called when the chunks of message from src stopped arriving"""
+
+    def stats_snapshot(self):
+        snapshot = self.stats.snapshot()
+        if self.sender.dropped:
+            snapshot['counters']['drop.send-queue-full'] = self.sender.dropped
+        return snapshot
+
+    def every(self, interval, callback):
+        """Calls callback every interval seconds until the node stops, also after it raised"""
+        def tick():
+            try:
+                callback()
+            except Exception:
+                logger.exception('Periodic %s failed', callback.__qualname__)
+            self.loop.call_later(interval, tick)
+        self.loop.call_later(interval, tick)
+
+
+class Host(Node):
+    kind = 'client'
+    hello = True
+
+    def __init__(self, my_ip=None, neighbors=None):
+        super().__init__(my_ip, neighbors)
+        self.handler = HostHandler(self)
 
     def broadcast(self, ttl=0):
-        logger.debug(f'Broadcasting with {ttl=}')
+        logger.debug('Broadcasting with ttl=%r', ttl)
+        message = self.broadcast_message(ttl)
         for neighbor in self.neighbors:
-            send(neighbor, { 'src': my_ip, 'dst': 'ALL', 'ttl': ttl })
+            self.send(neighbor, message)
+
 
+class HostHandler:
+    def __init__(self, host):
+        self.host = host
 
-class HostHandler(BaseRequestHandler):
-    def handle(self):
-        data = self.request[0]
+    async def handle(self, data, client_ip):
         data_len = len(data)
-        client_ip = self.client_address[0]
+        self.host.stats.received(client_ip, data_len)
+        self.host.liveness.heard(client_ip)
+        tracer.event('receive', src=client_ip, size=data_len)
         data = decode(data)
-        logger.info(f"Received {data_len}b from {client_ip}: {data}")
+        if 'hello' in data:
+            return
+        logger.info("Received %sb from %s: %s", data_len, client_ip, data)
 
-        if 'rip-update' in data:
+        if 'rip-update' in data or 'rip-resync' in data:
             logger.debug('Ignoring routing packet')
             return
         if 'monitor-request' in data:
@@ -100,98 +712,663 @@ class HostHandler(BaseRequestHandler):
         dst = data['dst']
         ttl = data['ttl']
 
-        if dst == my_ip or dst == 'ALL':
-            logger.info(f'Received packet FOR ME from {src}! Dropping.')
+        if dst == self.host.my_ip or dst == 'ALL':
+            logger.info('Received packet FOR ME from %s! Dropping.', src)
+            self.host.stats.count('delivered')
+            tracer.event('deliver', src=src, ttl=ttl)
             return
         else:
-            logger.error(f'Unexpected packet from {src}: {data=}')
+            logger.error('Unexpected packet from %s: data=%r', src, data)
+            self.host.stats.count('drop.not-for-me')
             return
 
 
 
 
 
-class Router:
-    def __init__(self):
-        self.forwarding_table = {}
+class RipScheduler:
+    """Coalesces RIP changes: everything scheduled within the hold-down window goes out as a single
+    update per neighbor, and two updates are always at least min_interval apart"""
+
+    def __init__(self, router, hold_down=RIP_HOLD_DOWN, min_interval=RIP_MIN_INTERVAL):
+        self.router = router
+        self.hold_down = hold_down
+        self.min_interval = min_interval
+        self.pending = {}
+        self.full = False
+        self.timer = None
+        self.last_flush = None
+
+    def schedule(self, changes=None, immediate=False):
+        """Queues changes ({ dst: kind }), or the whole table if changes is None"""
+        if changes is None:
+            self.full = True
+        else:
+            self.pending.update(changes)
+        if immediate:
+            self.flush()
+        elif self.timer is None:
+            delay = self.hold_down
+            if self.last_flush is not None:
+                delay = max(delay, self.last_flush + self.min_interval - self.router.loop.time())
+            self.timer = self.router.loop.call_later(delay, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.full:
+            self.router.broadcast_for_rip()
+        elif self.pending:
+            logger.debug('Flushing %s coalesced RIP changes', len(self.pending))
+            self.router.broadcast_for_rip(self.pending)
+        self.pending = {}
+        self.full = False
+        self.timer = None
+        self.last_flush = self.router.loop.time()
+
+
+class LinkState:
+    """Link-state routing on a router, in areas. For each of its areas the router originates an
+    LSA (sequence number, its links in that area, and summaries) that is flooded hop
+    by hop into the database of every router in the area, and it runs SPF on each area's database
+    itself. Neighbors that say they run link-state in their hello are adjacent in the areas both
+    are in and get those databases once. Every LSA sent to a neighbor is sent again every
+    LSA_RETRANSMIT seconds until that neighbor acks it; copies that are not newer than the one in
+    the database are acked but not flooded any further.
+
+    Routers in the backbone and another area are border routers. Only they fill in summaries,
+    [area, { dst: cost }] pairs for the hosts in area: into the backbone one for each of their
+    other areas, into the other areas one for everything reached through the backbone, merged into
+    prefixes (fib.summarize). So SPF only ever covers one area, and everything outside of it costs
+    a few summary routes per border router."""
+
+    def __init__(self, router):
+        self.router = router
+        self.seq = 0
+        self.lsdb = {}
+        self.adjacent = {}
+        self.neighbor_areas = {}
+        self.unacked = {}
+        self.timers = {}
+        # SPF result of each area, kept until a link in that area changes
+        self.routes = {}
+        self.summaries = {}
+        self.dirty = set()
+        self.originate_scheduled = False
+        self.spf_scheduled = False
+
+    def border(self):
+        return BACKBONE in self.router.areas and len(self.router.areas) > 1
+
+    def start(self):
+        self.originate()
+        # hellos carry our areas now, don't wait for the next one to form adjacencies
+        for neighbor in self.router.neighbors:
+            self.router.send(neighbor, self.router.hello_message())
+
+    def stop(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        self.__init__(self.router)
+
+    def links(self, area):
+        """Direct links in area: routers that are in it too, and hosts"""
+        neighbor_areas = self.neighbor_areas
+        return { dst: cost for dst, (next_hop, cost) in self.router.forwarding_table.items()
+                 if next_hop == dst and (dst not in neighbor_areas or area in neighbor_areas[dst]) }
+
+    def schedule_originate(self):
+        if not self.originate_scheduled:
+            self.originate_scheduled = True
+            self.router.loop.call_later(LSA_HOLD_DOWN, self.originate)
+
+    def originate(self, areas=None):
+        """New LSAs with the router's current links and summaries, for areas or all of them"""
+        self.originate_scheduled = False
+        if not self.router.link_state_mode:
+            return
+        my_ip = self.router.my_ip
+        for area in areas or self.router.areas:
+            links = self.links(area)
+            summary = self.summaries.get(area, [])
+            current = self.lsdb.get(area, {}).get(my_ip)
+            if current is not None and current[1] == links and current[2] == summary:
+                continue
+            self.seq += 1
+            lsa = (self.seq, links, summary)
+            logger.debug('Originating LSA %s for area %s with %s links', self.seq, area, len(lsa[1]))
+            self.router.stats.count('lsa.originated')
+            self.install(area, my_ip, lsa)
+            self.flood(area, { my_ip: lsa })
+
+    def install(self, area, origin, lsa):
+        lsdb = self.lsdb.setdefault(area, {})
+        current = lsdb.get(origin)
+        lsdb[origin] = lsa
+        # a changed summary doesn't change any path inside the area
+        if current is None or current[1] != lsa[1]:
+            self.dirty.add(area)
+        self.schedule_spf()
+
+    def flood(self, area, lsas, exclude=None):
+        self.send(area, [neighbor for neighbor in self.adjacent.get(area, ()) if neighbor != exclude], lsas)
+
+    def send(self, area, neighbors, lsas):
+        for neighbor in neighbors:
+            key = (neighbor, area)
+            pending = self.unacked.setdefault(key, {})
+            for origin, lsa in lsas.items():
+                pending[origin] = lsa[0]
+            if key not in self.timers:
+                self.timers[key] = self.router.loop.call_later(LSA_RETRANSMIT, self.retransmit, neighbor, area)
+        if neighbors:
+            self.router.send_all(neighbors, { 'lsa': lsas, 'area': area, 'src': self.router.my_ip })
+
+    def retransmit(self, neighbor, area):
+        key = (neighbor, area)
+        del self.timers[key]
+        pending = self.unacked.get(key)
+        if not pending or neighbor not in self.adjacent.get(area, ()):
+            return
+        logger.debug('Sending %s unacked LSAs of area %s to %s again', len(pending), area, neighbor)
+        self.router.stats.count('lsa.retransmitted', len(pending))
+        # pending always holds the sequence number of the copy in the database
+        lsdb = self.lsdb[area]
+        self.send(area, (neighbor,), { origin: lsdb[origin] for origin in pending })
+
+    def receive(self, lsas, area, src):
+        """Takes LSAs of area from src: acks all of them, installs and floods the newer ones, and
+        sends back the database's copy where src had an older one"""
+        if area not in self.router.areas:
+            logger.warning('Got LSAs for area %s from %s, which we are not in', area, src)
+            return
+        my_ip = self.router.my_ip
+        lsdb = self.lsdb.setdefault(area, {})
+        newer = {}
+        older = {}
+        pending = self.unacked.get((src, area), {})
+        for origin, lsa in lsas.items():
+            seq = lsa[0]
+            current = lsdb.get(origin)
+            if origin == my_ip:
+                # our own LSA from before a restart, continue after its sequence number
+                if seq > self.seq:
+                    self.seq = seq
+                    self.schedule_originate()
+            elif current is None or seq > current[0]:
+                newer[origin] = lsa = tuple(lsa)
+                self.install(area, origin, lsa)
+            elif seq < current[0]:
+                older[origin] = current
+            else:
+                self.router.stats.count('lsa.duplicate')
+                # the same copy coming back from src counts as its ack
+                if pending.get(origin) == seq:
+                    del pending[origin]
+        self.router.stats.count('lsa.received', len(lsas))
+        self.router.send(src, { 'lsa-ack': { origin: lsa[0] for origin, lsa in lsas.items() }, 'area': area, 'src': my_ip })
+        if newer:
+            self.flood(area, newer, exclude=src)
+        if older and src in self.adjacent.get(area, ()):
+            self.send(area, (src,), older)
+
+    def ack(self, acks, area, src):
+        pending = self.unacked.get((src, area))
+        if not pending:
+            return
+        for origin, seq in acks.items():
+            if pending.get(origin) == seq:
+                del pending[origin]
+
+    def hello(self, neighbor, areas):
+        """A hello proves the link, so it goes into our LSAs even if the neighbor's broadcast was
+        lost. Routers say which areas they are in, hosts say nothing."""
+        table = self.router.forwarding_table
+        entry = table.get(neighbor)
+        if entry is None or entry[0] != neighbor:
+            table[neighbor] = (neighbor, 1)
+            self.router.table_changed()
+            self.schedule_originate()
+        if not areas:
+            return
+        areas = set(areas)
+        if self.neighbor_areas.get(neighbor) != areas:
+            # which of our LSAs list the link depends on its areas
+            self.neighbor_areas[neighbor] = areas
+            self.schedule_originate()
+        for area in areas.intersection(self.router.areas):
+            self.adjacency_up(neighbor, area)
+
+    def adjacency_up(self, neighbor, area):
+        adjacent = self.adjacent.setdefault(area, set())
+        if neighbor in adjacent:
+            return
+        logger.info('Link-state adjacency with %s in area %s', neighbor, area)
+        adjacent.add(neighbor)
+        lsdb = self.lsdb.get(area)
+        if lsdb:
+            self.send(area, (neighbor,), dict(lsdb))
+
+    def adjacency_down(self, neighbor):
+        self.neighbor_areas.pop(neighbor, None)
+        for area, adjacent in self.adjacent.items():
+            adjacent.discard(neighbor)
+            self.unacked.pop((neighbor, area), None)
+            timer = self.timers.pop((neighbor, area), None)
+            if timer is not None:
+                timer.cancel()
+
+    def schedule_spf(self):
+        if not self.spf_scheduled:
+            self.spf_scheduled = True
+            self.router.loop.call_later(SPF_HOLD_DOWN, self.run_spf)
+
+    def run_spf(self):
+        """SPF for the areas whose links changed, then the forwarding table from all areas' routes
+        and summaries; border routers also advertise new summaries if theirs changed"""
+        self.spf_scheduled = False
+        router = self.router
+        if not router.link_state_mode:
+            return
+        for area in self.dirty:
+            lsdb = self.lsdb.get(area, {})
+            if router.my_ip not in lsdb: continue
+            started = time.perf_counter()
+            self.routes[area] = link_state_spf(lsdb, router.my_ip)
+            elapsed = time.perf_counter() - started
+            router.stats.observe('spf', elapsed)
+            tracer.event('spf', area=area, routers=len(lsdb), routes=len(self.routes[area]), seconds=elapsed)
+        self.dirty = set()
+        table = self.combine()
+        # links learned since our last LSA are not in the database yet
+        for dst, (next_hop, cost) in router.forwarding_table.items():
+            if next_hop == dst and dst not in table:
+                table[dst] = (next_hop, cost)
+        if table != router.forwarding_table or router.paths:
+            logger.debug('SPF changed the forwarding table, %s routes', len(table))
+            router.forwarding_table = ForwardingTable(table)
+            # SPF keeps a single next hop per destination
+            router.paths = {}
+            router.table_changed()
+        if self.border():
+            summaries = self.summarize(table)
+            changed = [area for area in router.areas if summaries[area] != self.summaries.get(area, [])]
+            self.summaries = summaries
+            if changed:
+                self.originate(changed)
+
+    def combine(self):
+        """Routes inside every area, then routes to everything else through the border routers'
+        summaries. Border routers only use the backbone's, and not those about their own areas,
+        so summaries never go in circles."""
+        table = {}
+        for routes in self.routes.values():
+            for dst, (next_hop, cost) in routes.items():
+                current = table.get(dst)
+                if current is None or (cost, next_hop) < (current[1], current[0]):
+                    table[dst] = (next_hop, cost)
+        inter = {}
+        border = self.border()
+        for area in (BACKBONE,) if border else self.router.areas:
+            routes = self.routes.get(area, {})
+            for origin, (_, _, summaries) in self.lsdb.get(area, {}).items():
+                to_origin = routes.get(origin)
+                if to_origin is None: continue
+                next_hop, cost = to_origin
+                for summary_area, summary in summaries:
+                    if border and summary_area in self.router.areas: continue
+                    for dst, summary_cost in summary.items():
+                        if dst in table: continue
+                        candidate = (cost + summary_cost, next_hop)
+                        current = inter.get(dst)
+                        if current is None or candidate < current:
+                            inter[dst] = candidate
+        for dst, (cost, next_hop) in inter.items():
+            table[dst] = (next_hop, cost)
+        return table
+
+    def summarize(self, table):
+        """{ area: summary } of a border router: the backbone gets the hosts the other areas reach
+        inside, every other area the hosts the router reaches outside of that area. Routers are
+        left out, nothing is ever sent to them across areas."""
+        routers = { origin for lsdb in self.lsdb.values() for origin in lsdb }
+        summaries = { BACKBONE: [] }
+        for area in self.router.areas:
+            if area == BACKBONE: continue
+            routes = self.routes.get(area, {})
+            inside = { dst: cost for dst, (_, cost) in routes.items() if dst not in routers }
+            summaries[BACKBONE].append([area, summarize(inside)])
+            outside = { dst: cost for dst, (_, cost) in table.items() if dst not in routes and dst not in routers }
+            summaries[area] = [[BACKBONE, summarize(outside)]]
+        return summaries
+
+
+class Router(Node):
+    """With workers > 1 this process is the control plane: it owns the forwarding table and
+    publishes read-only snapshots of it to worker processes that forward packets on the same port"""
+    kind = 'router'
+    hello = True
+
+    def __init__(self, my_ip=None, neighbors=None, hold_down=RIP_HOLD_DOWN, min_interval=RIP_MIN_INTERVAL, workers=1, areas=AREAS):
+        super().__init__(my_ip, neighbors)
+        self.areas = tuple(areas)
+        self.handler = RouterHandler(self)
+        self.forwarding_table = ForwardingTable()
+        # { dst: [next_hop, ...] } for the destinations with several equal cost next hops, the one in the table among them
+        self.paths = {}
+        self.flow_seed = zlib.crc32(self.my_ip.encode())
         self.rip_mode = False
-        assert RouterHandler.router is None
-        RouterHandler.router = self
+        self.link_state_mode = False
+        self.link_state = LinkState(self)
+        self.broadcasts = BroadcastFilter(self)
+        self.rip_seq = 0
+        self.rip_seq_received = {}
+        # { neighbor: rip_seq } from its last hello
+        self.rip_seq_announced = {}
+        self.rip_scheduler = RipScheduler(self, hold_down, min_interval)
+        self.workers = workers
+        self.reuse_port = workers > 1
+        self.worker_sockets = []
+        self.worker_channels = []
+        self.publish_scheduled = False
 
     def start_server(self):
-        logger.info('Starting router server')
-        self.server = UDPServer(server_address=('', PORT), RequestHandlerClass=RouterHandler)
-        self.server.serve_forever()
+        # fork before any event loop exists, every worker runs its own
+        context = multiprocessing.get_context('fork')
+        for _ in range(self.workers - 1):
+            sock, worker_sock = socket.socketpair()
+            context.Process(target=ForwardingWorker(worker_sock, self.my_ip, self.neighbors).start_server, daemon=True).start()
+            worker_sock.close()
+            self.worker_sockets.append(sock)
+        super().start_server()
+
+    def started(self):
+        self.worker_channels = [Channel(sock, self.loop, self.receive_from_worker) for sock in self.worker_sockets]
+
+    def receive_from_worker(self, message):
+        kind, *args = message
+        if kind == 'datagram':
+            self.spawn(self.handler.handle(*args))
+        elif kind == 'learn':
+            for src, client_ip in args[0]:
+                self.handler.learn(src, client_ip)
+
+    def table_changed(self):
+        if self.worker_channels and not self.publish_scheduled:
+            self.publish_scheduled = True
+            self.loop.call_soon(self.publish)
+
+    def publish(self):
+        self.publish_scheduled = False
+        snapshot = (self.forwarding_table.copy(), { dst: list(hops) for dst, hops in self.paths.items() })
+        # a worker still reading an older snapshot skips the ones in between
+        for channel in self.worker_channels:
+            channel.send_latest(snapshot)
 
     def broadcast(self, ttl=0):
-        logger.debug(f'Broadcasting with {ttl=}')
-        for neighbor in neighbors:
-            send(neighbor, { 'src': my_ip, 'dst': 'ALL', 'ttl': ttl })
-
-    def broadcast_for_rip(self):
-        logger.debug(f'Broadcasting forwarding table')
-        for neighbor in neighbors:
-            send(neighbor, { 'rip-update': self.forwarding_table, 'src': my_ip, 'dst': neighbor })
+        logger.debug('Broadcasting with ttl=%r', ttl)
+        message = self.broadcast_message(ttl)
+        for neighbor in self.neighbors:
+            self.send(neighbor, message)
+
+    def hello_message(self):
+        if self.link_state_mode:
+            return { 'hello': True, 'src': self.my_ip, 'link-state': list(self.areas) }
+        if self.rip_mode:
+            # so neighbors notice when the last update of a burst was lost
+            return { 'hello': True, 'src': self.my_ip, 'rip-seq': self.rip_seq }
+        return super().hello_message()
+
+    def broadcast_for_rip(self, changes=None):
+        """Sends the whole forwarding table, or only the entries in changes as a delta.
+        Every broadcast gets the next sequence number so neighbors can detect a missed delta."""
+        self.rip_seq += 1
+        if changes is None:
+            logger.debug('Broadcasting forwarding table, self.rip_seq=%r', self.rip_seq)
+            update = self.forwarding_table
+        else:
+            # removed routes go out as withdrawals
+            update = { dst: self.forwarding_table.get(dst, (self.my_ip, INFINITY)) for dst in changes }
+            logger.debug('Broadcasting %s changed routes, self.rip_seq=%r', len(update), self.rip_seq)
+        for neighbor in self.neighbors:
+            self.send(neighbor, { 'rip-update': self.poisoned(update, neighbor), 'src': self.my_ip, 'dst': neighbor, 'seq': self.rip_seq, 'delta': changes is not None })
+        self.stats.count('rip.sent', len(self.neighbors))
+
+    def send_rip_table(self, neighbor):
+        """Full resync for a single neighbor, keeps the current sequence number"""
+        logger.debug('Sending forwarding table to %s, self.rip_seq=%r', neighbor, self.rip_seq)
+        self.send(neighbor, { 'rip-update': self.poisoned(self.forwarding_table, neighbor), 'src': self.my_ip, 'dst': neighbor, 'seq': self.rip_seq, 'delta': False })
+        self.stats.count('rip.sent')
+
+    @staticmethod
+    def poisoned(update, neighbor):
+        """update as neighbor gets it: routes through neighbor are unreachable (poisoned reverse),
+        so neighbor never routes back through us when it loses its own route"""
+        return { dst: (next_hop, INFINITY) if next_hop == neighbor else (next_hop, cost) for dst, (next_hop, cost) in update.items() }
+
+    def neighbors_changed(self, added, removed):
+        for neighbor in removed:
+            self.liveness.forget(neighbor)
+            self.neighbor_down(neighbor)
+        for neighbor in added:
+            self.neighbor_up(neighbor)
+
+    def neighbor_down(self, neighbor):
+        """Drops every route through neighbor, or moves it to an equal cost next hop if it has one,
+        then lets RIP neighbors or the monitor know"""
+        removed = { dst: REMOVED for dst, (next_hop, _) in self.forwarding_table.items() if next_hop == neighbor }
+        for dst, hops in list(self.paths.items()):
+            if neighbor not in hops: continue
+            hops.remove(neighbor)
+            if dst in removed:
+                self.forwarding_table[dst] = (hops[0], self.forwarding_table[dst][1])
+                removed[dst] = NEXT_HOP_CHANGED
+            if len(hops) == 1:
+                del self.paths[dst]
+        for dst, change in removed.items():
+            if change == REMOVED:
+                del self.forwarding_table[dst]
+        logger.info('Removed or moved %s routes through %s', len(removed), neighbor)
+        if removed:
+            self.table_changed()
+        self.link_state.adjacency_down(neighbor)
+        self.topology_changed(removed)
+
+    def neighbor_up(self, neighbor):
+        self.forwarding_table[neighbor] = (neighbor, 1)
+        self.table_changed()
+        # so the neighbor learns about us too, like on start
+        self.send(neighbor, self.broadcast_message(0))
+        if self.rip_mode:
+            self.send_rip_table(neighbor)
+            self.request_rip_resync(neighbor)
+        self.topology_changed({ neighbor: ADDED })
+
+    def topology_changed(self, changes):
+        if self.rip_mode:
+            if changes:
+                self.rip_scheduler.schedule(changes)
+        elif self.link_state_mode:
+            self.link_state.schedule_originate()
+        else:
+            self.send(monitor_ip, { 'topology-changed': True, 'src': self.my_ip })
+
+    def transfer_lost(self, message, src):
+        if 'rip-update' in message:
+            self.request_rip_resync(src)
+
+    def answer_withdrawals(self, neighbor, update):
+        """Routes neighbor withdrew but we still have through someone else go straight back to it,
+        only the best route is kept so nobody else would tell it about the alternative. Answers are
+        outside the sequence of deltas (seq None): one must not stand in for a delta the neighbor lost."""
+        answers = {}
+        for dst, (next_hop, cost) in update.items():
+            # poisoned routes point at us, withdrawn ones at the neighbor
+            if cost >= INFINITY and next_hop != self.my_ip:
+                entry = self.forwarding_table.get(dst)
+                if entry is not None and entry[0] != neighbor:
+                    answers[dst] = entry
+        if answers:
+            self.stats.count('rip.withdrawals-answered')
+            self.send(neighbor, { 'rip-update': answers, 'src': self.my_ip, 'dst': neighbor, 'seq': None, 'delta': True })
+
+    def rip_hello(self, neighbor, seq):
+        """A missed delta shows in the next update, but the last one of a burst only in the hellos.
+        Behind on two hellos in a row, so the update isn't just still on its way, asks for a resync."""
+        previous = self.rip_seq_announced.get(neighbor)
+        self.rip_seq_announced[neighbor] = seq
+        if seq > self.rip_seq_received.get(neighbor, 0) and previous == seq:
+            logger.warning('Missed RIP update %s from %s. Requesting resync', seq, neighbor)
+            # and if the resync is lost too, again two hellos later
+            del self.rip_seq_announced[neighbor]
+            self.request_rip_resync(neighbor)
+
+    def request_rip_resync(self, neighbor):
+        self.stats.count('rip.resync-requested')
+        self.send(neighbor, { 'rip-resync': True, 'src': self.my_ip, 'dst': neighbor })
 
     def clear_all_table(self):
         logger.info('Clearing routing table')
-        self.forwarding_table = {}
+        self.forwarding_table = ForwardingTable()
+        self.paths = {}
+        self.table_changed()
+
+class RouterHandler:
+    def __init__(self, router):
+        self.router = router
 
-class RouterHandler(BaseRequestHandler):
-    router: Router = None
     def handle_monitor_request(self, data):
         request = data['monitor-request']
         if request == 'change-rip-status':
             enabled = data['enabled']
-            logger.info(f'Setting RIP mode to {enabled}')
+            logger.info('Setting RIP mode to %s', enabled)
             self.router.rip_mode = enabled
+            if enabled:
+                if self.router.link_state_mode:
+                    self.router.link_state_mode = False
+                    self.router.link_state.stop()
+                for neighbor in self.router.neighbors:
+                    self.router.request_rip_resync(neighbor)
+        elif request == 'change-link-state-status':
+            enabled = data['enabled']
+            logger.info('Setting link-state mode to %s', enabled)
+            if enabled == self.router.link_state_mode:
+                return
+            self.router.link_state_mode = enabled
+            if enabled:
+                self.router.rip_mode = False
+                self.router.link_state.start()
+            else:
+                self.router.link_state.stop()
         elif request == 'request-rip-table-for-ospf':
-            logger.debug(f'Sending forwarding table')
-            send(monitor_ip, { 'table': self.router.forwarding_table })
+            logger.debug('Sending forwarding table')
+            self.router.send(monitor_ip, { 'table': self.router.forwarding_table, 'round': data.get('round') })
         elif request == 'print-forwarding-table':
             from pprint import pprint
-            logger.info(f'Here is the current forwarding table as requested:')
+            logger.info('Here is the current forwarding table as requested:')
             pprint(self.router.forwarding_table)
         elif request == 'set-table':
-            logger.info(f"Setting table to {data['table']}")
+            logger.info("Setting table to %s", data['table'])
+            tracer.event('set-table', routes=len(data['table']))
             assert data['table'] is not None
-            self.router.forwarding_table = data['table']
+            table = data['table']
+            # OSPF results only cover hosts, keep our links so the next round still sees them
+            for dst, (next_hop, cost) in self.router.forwarding_table.items():
+                if next_hop == dst and dst not in table:
+                    table[dst] = (next_hop, cost)
+            paths = data.get('paths') or {}
+            # the round may have started before a neighbor went down
+            dead = self.router.liveness.dead
+            if dead:
+                table = { dst: entry for dst, entry in table.items() if entry[0] not in dead }
+                paths = { dst: hops for dst, hops in paths.items() if dst in table and dead.isdisjoint(hops) }
+            self.router.forwarding_table = ForwardingTable(table)
+            self.router.paths = paths
+            self.router.table_changed()
         elif request == 'trigger-rip':
             if not self.router.rip_mode:
                 logger.error('Sending RIP update, despite not in RIP mode')
-            logger.debug(f'Sending RIP update')
-            self.router.broadcast_for_rip()
+            logger.debug('Sending RIP update')
+            self.router.rip_scheduler.schedule(immediate=True)
         elif request == 'broadcast-with-ttl-0':
             self.router.broadcast()
         elif request == 'clear_all_table':
             self.router.clear_all_table()
+        elif request == 'get-stats':
+            self.router.send(monitor_ip, { 'stats': self.router.stats_snapshot() })
         else:
-            logger.error(f'Unknown request: {request}')
+            logger.error('Unknown request: %s', request)
 
-    def handle(self):
-        data = self.request[0]
+    async def handle(self, data, client_ip):
         data_len = len(data)
-        client_ip = self.client_address[0]
-        data = decode(data)
-        logger.info(f"Received {data_len}b from {client_ip}")
-
-        assert self.router is not None
+        self.router.stats.received(client_ip, data_len)
+        self.router.liveness.heard(client_ip)
+        tracer.event('receive', src=client_ip, size=data_len)
+        data = self.router.transfers.receive(decode(data), client_ip)
+        if data is None:
+            return
+        if 'hello' in data:
+            # a neighbor whose first broadcast was lost is only known from its hellos
+            if self.route(client_ip) is None:
+                self.learn(client_ip, client_ip)
+            if self.router.link_state_mode:
+                self.router.link_state.hello(client_ip, data.get('link-state'))
+            elif self.router.rip_mode and 'rip-seq' in data:
+                self.router.rip_hello(client_ip, data['rip-seq'])
+            return
+        logger.info("Received %sb from %s", data_len, client_ip)
 
         if data.get('monitor-request') is not None:
             logger.debug('It was a monitor node request')
             self.handle_monitor_request(data)
             return
 
+        if data.get('rip-resync') is not None:
+            logger.debug("It was a rip resync request from %s", data['src'])
+            self.router.send_rip_table(data['src'])
+            return
+
+        if 'lsa' in data or 'lsa-ack' in data:
+            if not self.router.link_state_mode:
+                logger.debug('Ignoring link-state packet, not in link-state mode')
+            elif 'lsa' in data:
+                self.router.link_state.receive(data['lsa'], data.get('area', BACKBONE), client_ip)
+            else:
+                self.router.link_state.ack(data['lsa-ack'], data.get('area', BACKBONE), client_ip)
+            return
+
         if data.get('rip-update') is not None:
             logger.debug('It was a rip update message')
-            if data['dst'] != my_ip:
-                logger.critical(f"Unexpected rip update message, intended for {data['dst']} but I am {my_ip}")
-            new_table = rip_new_table(self.router.forwarding_table, my_ip, data['rip-update'], data['src'])
-            if new_table is not None:
-                self.router.forwarding_table = new_table
-                self.router.broadcast_for_rip()
+            if data['dst'] != self.router.my_ip:
+                logger.critical("Unexpected rip update message, intended for %s but I am %s", data['dst'], self.router.my_ip)
+            self.router.stats.count('rip.received')
+            src = data['src']
+            seq = data.get('seq')
+            # answers to withdrawals have no sequence number and say nothing about missed deltas
+            if seq is not None:
+                last = self.router.rip_seq_received.get(src, 0)
+                # chunks of one update share its sequence number
+                if data.get('delta') and seq != last:
+                    expected = last + 1
+                    if seq != expected:
+                        logger.warning('Missed RIP update from %s: expected %s, got %s. Requesting resync', src, expected, seq)
+                        self.router.request_rip_resync(src)
+                self.router.rip_seq_received[src] = seq
+            started = time.perf_counter()
+            changes = rip_merge(self.router.forwarding_table, self.router.my_ip, data['rip-update'], src, self.router.paths, ECMP_PATHS)
+            elapsed = time.perf_counter() - started
+            self.router.stats.observe('rip-merge', elapsed)
+            tracer.event('rip-update', src=src, seq=seq, routes=len(data['rip-update']), changes=len(changes), seconds=elapsed)
+            if changes:
+                logger.debug('Routing table changed: %s', changes)
+                self.router.stats.count('rip.applied')
+                self.router.table_changed()
+                advertised = { dst: change for dst, change in changes.items() if change != PATHS_CHANGED }
+                if advertised:
+                    self.router.rip_scheduler.schedule(advertised)
             else:
                 logger.debug('Routing table unchanged')
+            self.router.answer_withdrawals(src, data['rip-update'])
             return
 
         logger.debug('It was a routing request')
@@ -199,131 +1376,399 @@ class RouterHandler(BaseRequestHandler):
         dst = data['dst']
         ttl = data['ttl']
 
-        if dst == my_ip:
-            logger.error(f'Unexpected packet for router from {src}. Dropping.')
+        if dst == self.router.my_ip:
+            logger.error('Unexpected packet for router from %s. Dropping.', src)
+            self.router.stats.count('drop.for-router')
+            tracer.event('drop', reason='for-router', src=src, dst=dst)
+            return
+
+        seq = data.get('seq')
+        if dst == 'ALL' and (reason := self.router.broadcasts.check(src, seq, client_ip)) is not None:
+            # before learning, a copy that went the long way around would conflict with the route to src
+            logger.debug('Dropping broadcast %s from %s: %s', seq, src, reason)
+            self.router.stats.count(f'drop.{reason}')
+            tracer.event('drop', reason=reason, src=src, dst=dst)
             return
 
-        forwarding_table_changed = False
+        self.learn(src, client_ip)
+        self.forward(src, dst, ttl, client_ip, seq)
 
-        current_entry = self.router.forwarding_table.get(src, None)
+    def learn(self, src, client_ip):
+        current_entry = self.route(src)
         if current_entry is None:
-            logger.debug(f'Adding new forwarding table entry: {src} is at {client_ip}')
+            logger.debug('Adding new forwarding table entry: %s is at %s', src, client_ip)
             self.router.forwarding_table[src] = (client_ip, 1)
-            forwarding_table_changed = True
-        elif current_entry[0] != client_ip:
-            logger.error(f"Conflicting forwarding table: got {src} from {client_ip}, previously at {current_entry}")
+            tracer.event('learn', dst=src, next_hop=client_ip)
+            self.router.table_changed()
+            if self.router.rip_mode:
+                logger.debug('Scheduling RIP update')
+                self.router.rip_scheduler.schedule({ src: ADDED })
+            elif self.router.link_state_mode and src == client_ip:
+                self.router.link_state.schedule_originate()
+        elif current_entry[0] != client_ip and client_ip not in self.router.paths.get(src, ()):
+            logger.error("Conflicting forwarding table: got %s from %s, previously at %s", src, client_ip, current_entry)
         else:
-            logger.debug(f"{src} is already forwarded to {client_ip}")
-            pass
+            logger.debug("%s is already forwarded to %s", src, client_ip)
 
+    def forward(self, src, dst, ttl, client_ip, seq=None):
         if ttl == 0:
-            logger.warning(f'Dropping packet from {src} to {dst} due to TTL')
+            logger.warning('Dropping packet from %s to %s due to TTL', src, dst)
+            self.router.stats.count('drop.ttl')
+            tracer.event('drop', reason='ttl', src=src, dst=dst)
 
         elif dst == 'ALL':
-            logger.debug(f'Broadcasting packet from {src} to {dst}')
+            logger.debug('Broadcasting packet from %s to %s', src, dst)
+            self.router.stats.count('broadcast')
+            tracer.event('broadcast', src=src, ttl=ttl)
+            message = { 'src': src, 'dst': dst, 'ttl': ttl - 1 }
+            if seq is not None:
+                message['seq'] = seq
             for neighbor in self.router.neighbors:
                 if neighbor == client_ip: continue # Don't send it to source
-                send(neighbor, { 'src': src, 'dst': dst, 'ttl': ttl - 1 })
+                self.router.send(neighbor, message)
 
-        elif dst in self.router.forwarding_table:
-            logger.debug(f'Forwarding packet from {src} to {dst}')
-            send(self.router.forwarding_table[dst][0], { 'src': src, 'dst': dst, 'ttl': ttl - 1 })
+        elif (next_hop := self.next_hop(src, dst)) is not None:
+            logger.debug('Forwarding packet from %s to %s', src, dst)
+            self.router.stats.count('forwarded')
+            tracer.event('forward', src=src, dst=dst, ttl=ttl, next_hop=next_hop)
+            self.router.send(next_hop, { 'src': src, 'dst': dst, 'ttl': ttl - 1 })
 
         else:
-            logger.warning(f'Dropping packet from {src} to {dst} due to no route')
-
-        if forwarding_table_changed and self.router.rip_mode:
-            logger.debug(f'Sending RIP update')
-            self.router.broadcast_for_rip()
-
-
-
-
+            logger.warning('Dropping packet from %s to %s due to no route', src, dst)
+            self.router.stats.count('drop.no-route')
+            tracer.event('drop', reason='no-route', src=src, dst=dst)
+
+    def next_hop(self, src, dst):
+        """Next hop of the flow src -> dst, or None without a route. Of several equal cost next hops the
+        flow hash picks one, so all packets of a flow take the same path and arrive in order; the hash
+        is seeded per router so routers along a path don't all make the same choice."""
+        entry = self.route(dst)
+        if entry is None:
+            return None
+        hops = self.router.paths.get(dst)
+        if hops is None:
+            return entry[0]
+        return hops[zlib.crc32(f'{src}>{dst}'.encode(), self.router.flow_seed) % len(hops)]
+
+    def route(self, dst):
+        """Exact host route first, otherwise the longest matching prefix route"""
+        table = self.router.forwarding_table
+        # a destination packets went to before is one dict hit, like when the table was a dict
+        return table.routes.get(dst) or table.route(dst)
+
+
+class ForwardingWorker(Node):
+    """Data plane process of a multi-worker router. Forwards packets from the latest snapshot of the
+    control plane's forwarding table and hands everything else to the control plane."""
+    kind = 'forwarding worker'
+    reuse_port = True
+    control = False
+    hello = False
+
+    def __init__(self, sock, my_ip, neighbors):
+        super().__init__(my_ip, neighbors)
+        self.handler = ForwardingHandler(self)
+        self.sock = sock
+        self.channel = None
+        self.forwarding_table = ForwardingTable()
+        self.paths = {}
+        self.flow_seed = zlib.crc32(self.my_ip.encode())
+        # { src: client_ip } to be learned by the control plane, sent once per event loop iteration
+        self.learning = {}
+        # sources asked for since the last snapshot
+        self.asked = set()
+
+    def started(self):
+        self.channel = Channel(self.sock, self.loop, self.receive_snapshot)
+
+    def receive_snapshot(self, snapshot):
+        # reference swaps between two packets, packets see either the old or the new table; the worker
+        # never changes its copy
+        self.forwarding_table, self.paths = snapshot
+        # sources the control plane didn't learn after all are asked for again
+        self.asked.clear()
+
+    def to_control_plane(self, data, client_ip):
+        if self.channel.backlog > WORKER_BACKLOG:
+            logger.warning('Control plane is behind, dropping datagram from %s', client_ip)
+            self.stats.count('drop.worker-backlog')
+            return
+        self.channel.send(('datagram', data, client_ip))
 
-class Monitor:
-    def __init__(self):
-        self.table_received = None
-        assert MonitorHandler.monitor is None
-        MonitorHandler.monitor = self
+    def learn(self, src, client_ip):
+        if src in self.asked:
+            return
+        self.asked.add(src)
+        if not self.learning:
+            self.loop.call_soon(self.send_learning)
+        self.learning[src] = client_ip
+
+    def send_learning(self):
+        self.channel.send(('learn', list(self.learning.items())))
+        self.learning = {}
+
+
+class ForwardingHandler(RouterHandler):
+    async def handle(self, data, client_ip):
+        self.router.stats.received(client_ip, len(data))
+        message = decode(data)
+        # broadcasts too, so each one is checked against the one cache of the control plane
+        if 'ttl' not in message or message['dst'] == 'ALL':
+            self.router.to_control_plane(data, client_ip)
+            return
+        src, dst, ttl = message['src'], message['dst'], message['ttl']
+        if dst == self.router.my_ip:
+            logger.error('Unexpected packet for router from %s. Dropping.', src)
+            self.router.stats.count('drop.for-router')
+            tracer.event('drop', reason='for-router', src=src, dst=dst)
+            return
+        self.learn(src, client_ip)
+        self.forward(src, dst, ttl, client_ip)
+
+    def learn(self, src, client_ip):
+        if self.route(src) is None:
+            self.router.learn(src, client_ip)
+
+
+
+
+
+class OspfRound:
+    """Collects a forwarding table from every router for one OSPF computation.
+    Each round has an ID that routers echo back, so late replies to an old round are not mixed in.
+    Routers that haven't answered are asked again every retransmit seconds; at the deadline the
+    last table received from each missing router stands in for it, so set-table always goes out."""
+
+    def __init__(self, monitor, retransmit=OSPF_RETRANSMIT, deadline=OSPF_DEADLINE):
+        self.monitor = monitor
+        self.retransmit = retransmit
+        self.deadline = deadline
+        self.id = 0
+        self.outstanding = set()
+        self.tables = None
+        self.last_tables = {}
+        self.timers = []
+
+    def start(self):
+        if self.tables is not None:
+            logger.warning('Starting OSPF round %s before round %s finished', self.id + 1, self.id)
+            self.cancel_timers()
+        self.id += 1
+        logger.info('Starting OSPF round %s', self.id)
+        self.tables = {}
+        self.outstanding = set(self.monitor.neighbors)
+        self.request(self.outstanding)
+        loop = self.monitor.loop
+        self.timers = [loop.call_later(self.retransmit, self.resend), loop.call_later(self.deadline, self.expire)]
+
+    def request(self, routers):
+        for router in routers:
+            self.monitor.send(router, { 'monitor-request': 'request-rip-table-for-ospf', 'round': self.id })
+
+    def resend(self):
+        logger.debug('OSPF round %s: asking %s again', self.id, self.outstanding)
+        self.request(self.outstanding)
+        self.timers[0] = self.monitor.loop.call_later(self.retransmit, self.resend)
+
+    def receive(self, router, table, round_id):
+        """Takes a table reply; round_id is None for routers that don't echo it"""
+        self.last_tables[router] = table
+        if self.tables is None or round_id not in (None, self.id) or router not in self.outstanding:
+            logger.debug('Table from %s is not for OSPF round %s', router, self.id)
+            return
+        self.outstanding.discard(router)
+        self.tables[router] = table
+        if not self.outstanding:
+            self.finish()
+        else:
+            logger.debug('OSPF round %s: still waiting for %s routers', self.id, len(self.outstanding))
+
+    def expire(self):
+        logger.warning('OSPF round %s: no table from %s, using their last known tables', self.id, sorted(self.outstanding))
+        for router in self.outstanding:
+            self.tables[router] = self.last_tables.get(router, {})
+        self.monitor.stats.count('ospf.missing-tables', len(self.outstanding))
+        self.finish()
+
+    def finish(self):
+        self.cancel_timers()
+        tables = self.tables
+        self.tables = None
+        self.outstanding = set()
+        self.monitor.spawn(self.monitor.handler.push_tables(tables))
+
+    def cancel_timers(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.timers = []
+
+
+class Monitor(Node):
+    kind = 'monitor'
+
+    def __init__(self, my_ip=None, neighbors=None, incremental=True, aggregate=False):
+        super().__init__(my_ip, neighbors)
+        self.handler = MonitorHandler(self)
+        self.ospf_round = OspfRound(self)
+        self.ospf = OspfEngine(ECMP_PATHS) if incremental else None
+        self.aggregate = aggregate
+        self.ospf_lock = asyncio.Lock()
+        self.stats_received = None
+        self.stats_timer = None
+        self.ospf_scheduled = False
+
+    def schedule_ospf(self):
+        """Starts one OSPF round for all topology changes reported within TOPOLOGY_HOLD_DOWN"""
+        if not self.ospf_scheduled:
+            self.ospf_scheduled = True
+            self.loop.call_later(TOPOLOGY_HOLD_DOWN, self.scheduled_ospf)
+
+    def scheduled_ospf(self):
+        self.ospf_scheduled = False
+        self.trigger_ospf()
 
     def trigger_br_all(self):
-        for neighbor in neighbors:
-            send(neighbor, { 'monitor-request': 'broadcast-with-ttl-0' })
+        for neighbor in self.neighbors:
+            self.send(neighbor, { 'monitor-request': 'broadcast-with-ttl-0' })
 
     def trigger_ospf(self):
-        for neighbor in neighbors:
-            send(neighbor, { 'monitor-request': 'request-rip-table-for-ospf' })
+        if self.loop is None:
+            # rounds live in the long running monitor process, hand it over
+            self.send(monitor_ip, { 'monitor-request': 'trigger-ospf' })
+        else:
+            self.ospf_round.start()
 
     def trigger_rip(self, target_ip=None):
         if target_ip is None:
-            for neighbor in neighbors:
-                send(neighbor, { 'monitor-request': 'trigger-rip' })
+            for neighbor in self.neighbors:
+                self.send(neighbor, { 'monitor-request': 'trigger-rip' })
         else:
-            send(target_ip, { 'monitor-request': 'trigger-rip' })
+            self.send(target_ip, { 'monitor-request': 'trigger-rip' })
 
     def rip_mode(self, enabled):
-        for neighbor in neighbors:
-            send(neighbor, { 'monitor-request': 'change-rip-status', 'enabled': enabled })
+        for neighbor in self.neighbors:
+            self.send(neighbor, { 'monitor-request': 'change-rip-status', 'enabled': enabled })
+
+    def link_state_mode(self, enabled):
+        for neighbor in self.neighbors:
+            self.send(neighbor, { 'monitor-request': 'change-link-state-status', 'enabled': enabled })
 
     def clear_all_table(self, router_ip):
         if router_ip is None:
-            for neighbor in neighbors:
-                send(neighbor, { 'monitor-request': 'clear_all_table' })
+            for neighbor in self.neighbors:
+                self.send(neighbor, { 'monitor-request': 'clear_all_table' })
         else:
-            send(router_ip, { 'monitor-request': 'clear_all_table' })
+            self.send(router_ip, { 'monitor-request': 'clear_all_table' })
 
     def print_table(self, router_ip):
-        send(router_ip, { 'monitor-request': 'print-forwarding-table' })
+        self.send(router_ip, { 'monitor-request': 'print-forwarding-table' })
 
     def print_all_table(self):
-        for neighbor in neighbors:
-            send(neighbor, { 'monitor-request': 'print-forwarding-table' })
-
-    def start_server(self):
-        logger.info('Starting monitor server')
-        self.server = UDPServer(server_address=('', PORT), RequestHandlerClass=MonitorHandler)
-        self.server.serve_forever()
-
-
-class MonitorHandler(BaseRequestHandler):
-    monitor: Monitor = None
-
-    def handle(self):
-        data = self.request[0]
-        client_ip = self.client_address[0]
-        data = decode(data)
-        logger.info(f"Received routing table from {client_ip}")
-
-        assert self.monitor is not None
+        for neighbor in self.neighbors:
+            self.send(neighbor, { 'monitor-request': 'print-forwarding-table' })
 
-        if self.monitor.table_received is None:
-            logger.info(f'Starting new routing table update process')
-            self.monitor.table_received = { client_ip: data['table'] }
+    def gather_stats(self):
+        for neighbor in self.neighbors:
+            self.send(neighbor, { 'monitor-request': 'get-stats' })
+
+    def report_stats(self):
+        """Prints the network-wide stats of every router that replied, plus the monitor's own"""
+        if self.stats_timer is not None:
+            self.stats_timer.cancel()
+        snapshots = self.stats_received
+        self.stats_received = None
+        self.stats_timer = None
+        missing = [neighbor for neighbor in self.neighbors if neighbor not in snapshots]
+        if missing:
+            logger.warning('No stats from %s', missing)
+        snapshots[self.my_ip] = self.stats_snapshot()
+        print(format_report(snapshots))
+
+
+class MonitorHandler:
+    def __init__(self, monitor):
+        self.monitor = monitor
+
+    def compute(self, tables):
+        """(tables, equal cost next hops) of every router"""
+        started = time.perf_counter()
+        if self.monitor.ospf is None:
+            paths = {}
+            result = ospf_algo(tables, aggregate=self.monitor.aggregate, paths=paths, max_paths=ECMP_PATHS)
         else:
-            self.monitor.table_received[client_ip] = data['table']
-
-        not_received = [neighbor for neighbor in neighbors if neighbor not in self.monitor.table_received]
-        if len(not_received) == 0:
-            logger.debug(f'Calculating new routing table')
-            tables_to_send = ospf_algo(self.monitor.table_received)
-            self.monitor.table_received = None
-            for neighbor in neighbors:
-                send(neighbor, { 'monitor-request': 'set-table', 'table': tables_to_send[neighbor] })
+            result = self.monitor.ospf.update(tables)
+            paths = self.monitor.ospf.paths
+            if self.monitor.aggregate:
+                result = { router: aggregate(table) for router, table in result.items() }
+        if self.monitor.aggregate:
+            # hosts merged into a prefix route use the prefix's single next hop
+            paths = { router: { dst: hops for dst, hops in router_paths.items() if dst in result[router] } for router, router_paths in paths.items() }
+        elapsed = time.perf_counter() - started
+        self.monitor.stats.observe('ospf', elapsed)
+        tracer.event('ospf', routers=len(tables), seconds=elapsed)
+        return result, paths
+
+    def collect_stats(self, snapshot, client_ip):
+        if self.monitor.stats_received is None:
+            self.monitor.stats_received = {}
+            self.monitor.stats_timer = self.monitor.loop.call_later(STATS_TIMEOUT, self.monitor.report_stats)
+        self.monitor.stats_received[client_ip] = snapshot
+        if all(neighbor in self.monitor.stats_received for neighbor in self.monitor.neighbors):
+            self.monitor.report_stats()
+
+    async def handle(self, data, client_ip):
+        self.monitor.stats.received(client_ip, len(data))
+        data = self.monitor.transfers.receive(decode(data), client_ip)
+        if data is None:
             return
-        else:
-            logger.debug(f'Still waiting response from {not_received}')
-
+        if data.get('monitor-request') == 'trigger-ospf':
+            self.monitor.trigger_ospf()
+            return
+        if 'topology-changed' in data:
+            logger.info('Topology around %s changed, recomputing OSPF', client_ip)
+            self.monitor.schedule_ospf()
+            return
+        if 'stats' in data:
+            logger.info("Received stats from %s", client_ip)
+            self.collect_stats(data['stats'], client_ip)
+            return
+        logger.info("Received routing table from %s", client_ip)
+        self.monitor.ospf_round.receive(client_ip, data['table'], data.get('round'))
+
+    async def push_tables(self, tables):
+        logger.debug('Calculating new routing table')
+        # SPF runs off the event loop so datagrams keep flowing while it computes
+        async with self.monitor.ospf_lock:
+            tables_to_send, paths = await self.monitor.loop.run_in_executor(None, self.compute, tables)
+        for neighbor in self.monitor.neighbors:
+            table = tables_to_send.get(neighbor)
+            # a router that joined during the round gets its table from the next one
+            if table is None: continue
+            message = { 'monitor-request': 'set-table', 'table': table }
+            if neighbor in paths:
+                message['paths'] = paths[neighbor]
+            self.monitor.send(neighbor, message)
 
 
 if __name__ == '__main__':
-    logger.debug(f'Found neighbors: {neighbors}')
+    my_ip = get_my_ip()
+    neighbors = get_neighbors()
+
+    if os.environ.get('TRACE'):
+        # only errors on the console, everything else goes into the trace
+        os.makedirs(os.environ['TRACE'], exist_ok=True)
+        tracer.start(os.path.join(os.environ['TRACE'], f'{my_ip}.jsonl'), parse_sample(os.environ.get('TRACE_SAMPLE', '')))
+        logging.getLogger('').addHandler(FlightRecorderHandler(tracer))
+        logger.setLevel(logging.ERROR)
+    logger.debug('Found neighbors: %s', neighbors)
 
     if len(argv) == 1:
-        logger.error('Available commands: start, broadcast, send, get')
+        logger.error('Available commands: start, %s', ', '.join(HOST_COMMANDS + MONITOR_COMMANDS))
         exit(1)
 
+    # long running nodes discover their own neighbors, so they also watch them for changes
     if argv[1] == 'start' and my_ip.endswith('255'):
-        h = Monitor()
+        h = Monitor(aggregate='aggregate' in argv[2:])
         h.start_server()
 
     elif argv[1] == 'start' and len(neighbors) == 1:
@@ -332,62 +1777,21 @@ if __name__ == '__main__':
         h.start_server()
 
     elif argv[1] == 'start':
-        h = Router()
+        h = Router(workers=int(argv[2]) if len(argv) > 2 else 1)
         h.broadcast()
         h.start_server()
 
-    elif argv[1] == 'broadcast':
-        h = Host()
-        h.broadcast(ttl=int(argv[2]) if len(argv) > 2 else 0)
-
-    elif argv[1] == 'send':
-        if len(argv) <= 2:
-            logger.error('send <dst> [ttl]')
-            exit(1)
-        assert len(neighbors) == 1
-        through = neighbors[0]
-        dst = normalize_ip(argv[2])
-        src = my_ip
-        ttl = int(argv[3]) if len(argv) > 4 else 5
-        send(through, { 'src': src, 'dst': dst, 'ttl': ttl })
-
-    elif argv[1] == 'print':
-        if len(argv) <= 2:
-            logger.error('print <router | all>')
-            exit(1)
-        m = Monitor()
-        if argv[2] == 'all':
-            m.print_all_table()
-        else:
-            m.print_table(normalize_ip(argv[2]))
-
-    elif argv[1] == 'br-all':
-        m = Monitor()
-        m.trigger_br_all()
-
-    elif argv[1] == 'trigger-ospf':
-        m = Monitor()
-        m.trigger_ospf()
-
-    elif argv[1] == 'trigger-rip':
-        if len(argv) <= 2:
-            logger.error('trigger-rip <router | all>')
-            exit(1)
-        m = Monitor()
-        m.trigger_rip(None if argv[2] == 'all' else normalize_ip(argv[2]))
-
-    elif argv[1] == 'rip-on':
-        m = Monitor()
-        m.rip_mode(True)
-
-    elif argv[1] == 'rip-off':
-        m = Monitor()
-        m.rip_mode(False)
-
-    elif argv[1] == 'clear':
-        m = Monitor()
-        m.clear_all_table(None if len(argv) <= 2 else normalize_ip(argv[2]))
-
     else:
-        logger.error(f'Unknown command: {argv[1]}')
-        exit(1)
+        try:
+            # a running node takes the command over its control socket and runs it in its own process
+            replies = send_commands([' '.join(argv[1:])], control_path(my_ip))
+            if replies != ['ok']:
+                logger.error('%s', replies[0])
+                exit(1)
+        except (FileNotFoundError, ConnectionRefusedError):
+            node = Monitor(my_ip, neighbors) if argv[1] in MONITOR_COMMANDS else Host(my_ip, neighbors)
+            try:
+                run_command(node, argv[1:])
+            except (CommandError, ValueError) as e:
+                logger.error('%s', e)
+                exit(1)
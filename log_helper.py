@@ -1,4 +1,10 @@
+import json
 import logging
+import os
+import queue
+import threading
+import time
+from collections import Counter, deque
 
 
 class Color:
@@ -33,6 +39,9 @@ class ColorLogFormatter(logging.Formatter):
         "CRITICAL": {'prefix': Color.BOLD_RED, 'suffix': Color.END},
     }
 
+    def __init__(self):
+        super().__init__(self.FORMAT)
+
     def format(self, record):
         """Format log records with a default prefix and suffix to terminal color codes that corresponds to the log level name."""
         if not hasattr(record, 'prefix'):
@@ -41,5 +50,144 @@ class ColorLogFormatter(logging.Formatter):
         if not hasattr(record, 'suffix'):
             record.suffix = self.LOG_LEVEL_COLOR.get(record.levelname.upper()).get('suffix')
 
-        formatter = logging.Formatter(self.FORMAT)
-        return formatter.format(record)
+        return super().format(record)
+
+
+FLIGHT_RECORDER_SIZE = 4096
+# errors can come once per packet, the flight recorder is written out at most this often
+FLIGHT_RECORDER_INTERVAL = 1.0
+
+
+class Tracer:
+    """Structured trace events written as JSON lines by a background thread.
+
+    event() only puts (time, kind, fields) on a queue; turning it into JSON happens on the writer
+    thread, so fields must not be mutated afterwards (pass sizes, not tables). sample maps an event
+    kind to n, keeping one in n of those events. Every event, sampled out or not, also goes into a
+    ring buffer (the flight recorder) that dump() writes out. FlightRecorderHandler has the writer thread
+    do that on errors (dump_later), with a copy of the buffer and at most once per FLIGHT_RECORDER_INTERVAL."""
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.sample = {}
+        self.seen = Counter()
+        self.recorder = deque(maxlen=FLIGHT_RECORDER_SIZE)
+        self.queue = None
+        self.forked = False
+        self.dumped = None
+
+    def start(self, path, sample=None, recorder_size=FLIGHT_RECORDER_SIZE):
+        self.path = path
+        self.sample = sample or {}
+        self.recorder = deque(maxlen=recorder_size)
+        self.queue = queue.SimpleQueue()
+        self.enabled = True
+        threading.Thread(target=self.write, args=(self.queue, open(path, 'a')), daemon=True).start()
+        if not self.forked:
+            # forked processes don't inherit the writer thread, they get their own file
+            self.forked = True
+            os.register_at_fork(after_in_child=lambda: self.start(f'{self.path}.{os.getpid()}', self.sample, self.recorder.maxlen))
+
+    def event(self, kind, **fields):
+        if not self.enabled:
+            return
+        record = (time.time(), kind, fields)
+        self.recorder.append(record)
+        every = self.sample.get(kind)
+        if every is not None:
+            self.seen[kind] += 1
+            if self.seen[kind] % every:
+                return
+        self.queue.put(record)
+
+    def write(self, records, file):
+        while True:
+            record = records.get()
+            if isinstance(record, list):
+                # a copy of the flight recorder from dump_later
+                self.write_flight(record)
+            else:
+                file.write(self.format(record))
+            if records.empty():
+                file.flush()
+
+    @staticmethod
+    def format(record):
+        when, kind, fields = record
+        return json.dumps({ 't': round(when, 6), 'event': kind, **fields }, default=str) + '\n'
+
+    def dump(self):
+        """Writes the flight recorder next to the trace, returns its path"""
+        return self.write_flight(list(self.recorder))
+
+    def dump_later(self):
+        """dump() on the writer thread, unless that was asked for less than FLIGHT_RECORDER_INTERVAL ago.
+        Returns whether it will happen"""
+        now = time.monotonic()
+        if self.dumped is not None and now - self.dumped < FLIGHT_RECORDER_INTERVAL:
+            return False
+        self.dumped = now
+        self.queue.put(list(self.recorder))
+        return True
+
+    def write_flight(self, records):
+        path = f'{self.path}.flight'
+        with open(path, 'w') as file:
+            file.writelines(map(self.format, records))
+        return path
+
+
+class FlightRecorderHandler(logging.Handler):
+    """Dumps the tracer's flight recorder whenever an error is logged"""
+
+    def __init__(self, tracer):
+        super().__init__(logging.ERROR)
+        self.tracer = tracer
+
+    def emit(self, record):
+        if self.tracer.enabled:
+            self.tracer.event('error', message=record.getMessage())
+            self.tracer.dump_later()
+
+
+def parse_sample(spec):
+    """'packet=100,rip-update=10' -> { 'packet': 100, 'rip-update': 10 }"""
+    sample = {}
+    for item in filter(None, spec.split(',')):
+        kind, _, every = item.partition('=')
+        sample[kind.strip()] = int(every)
+    return sample
+
+
+if __name__ == '__main__':
+    import tempfile
+    print('Running tests')
+    assert parse_sample('send=10, receive=2') == { 'send': 10, 'receive': 2 }
+    with tempfile.TemporaryDirectory() as directory:
+        tracer = Tracer()
+        tracer.event('send', to='10.0.0.1', size=30) # not started, ignored
+        tracer.start(os.path.join(directory, 'trace.jsonl'), { 'send': 10 }, recorder_size=5)
+        for i in range(20):
+            tracer.event('send', to='10.0.0.1', size=i)
+        tracer.event('drop', reason='ttl')
+        logger = logging.getLogger('test')
+        logger.addHandler(FlightRecorderHandler(tracer))
+        logger.error('Something broke')
+        time.sleep(0.1)
+        with open(tracer.path) as file:
+            events = [json.loads(line) for line in file]
+        assert [event['event'] for event in events] == ['send', 'send', 'drop', 'error']
+        assert events[0]['size'] == 9 and events[1]['size'] == 19
+        with open(f'{tracer.path}.flight') as file:
+            events = [json.loads(line) for line in file]
+        assert [event.get('size') for event in events] == [17, 18, 19, None, None]
+        assert events[-1] == { 't': events[-1]['t'], 'event': 'error', 'message': 'Something broke' }
+        # right after that one, errors only go into the trace
+        logger.error('Something else broke')
+        assert not tracer.dump_later()
+        time.sleep(0.1)
+        with open(f'{tracer.path}.flight') as file:
+            assert 'Something else' not in file.read()
+        with open(tracer.path) as file:
+            assert 'Something else' in file.read()
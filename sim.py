@@ -0,0 +1,567 @@
+#!/usr/bin/env python
+"""Discrete-event simulator for the nodes in host.py.
+
+The real Host, Router and Monitor classes and their handlers run on virtual nodes; only the
+event loop and the UDP links are replaced, by a virtual clock and simulated links with their
+own delay and loss. This runs net1/net2/net3 from topo.py, or generated topologies with
+thousands of routers, in seconds and without mininet.
+
+    python sim.py net3
+    python sim.py random 1000 --protocol ospf --loss 0.01
+    python sim.py grid 100 --cut random
+    python sim.py fat-tree 8 --protocol link-state
+    python sim.py grid 400 --protocol link-state --areas 4
+"""
+# c-spell: ignore ospf
+
+import argparse
+import itertools
+import logging
+import random
+import time
+from collections import Counter, deque
+from heapq import heappush, heappop
+from host import Host, Router, Monitor, monitor_ip, logger, AREAS, BACKBONE
+
+# with --cut, hellos run this long before the link fails, and the reconvergence is watched this long
+CUT_SETTLE = 1.0
+CUT_OBSERVE = 2.0
+# link-state routers keep saying hello, so convergence is watched for a fixed virtual time
+LINK_STATE_OBSERVE = 2.0
+# with loss, RIP routers say hello too, which is how they find out they missed the last update of a
+# burst, so convergence is watched for a fixed virtual time as well
+RIP_LOSS_OBSERVE = 3.0
+# with --broadcast, the copies of one broadcast are counted for this long once the routes are in
+BROADCAST_OBSERVE = 1.0
+
+
+class VirtualHandle:
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FinishedTask:
+    def add_done_callback(self, callback):
+        callback(self)
+
+
+class VirtualLoop:
+    """The parts of an asyncio event loop the nodes use, on a virtual clock.
+    Handlers run to completion as soon as they are spawned, so they must not suspend."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.queue = []
+        self.counter = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def call_later(self, delay, callback, *args):
+        handle = VirtualHandle(callback, args)
+        heappush(self.queue, (self.now + delay, next(self.counter), handle))
+        return handle
+
+    def call_soon(self, callback, *args):
+        return self.call_later(0, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        return self.call_later(when - self.now, callback, *args)
+
+    def create_task(self, coroutine):
+        try:
+            coroutine.send(None)
+        except StopIteration:
+            return FinishedTask()
+        raise RuntimeError('Simulated handlers cannot suspend')
+
+    async def run_in_executor(self, executor, function, *args):
+        return function(*args)
+
+    def run(self, until=None):
+        """Runs events until there are none left, or until the virtual time until"""
+        while self.queue:
+            when, _, handle = self.queue[0]
+            if until is not None and when > until:
+                self.now = until
+                return
+            heappop(self.queue)
+            if handle.cancelled: continue
+            self.now = when
+            handle.callback(*handle.args)
+
+
+class LinkSender:
+    """Takes the place of a node's Sender: datagrams go onto the simulated links"""
+
+    def __init__(self, network, src):
+        self.network = network
+        self.src = src
+        self.dropped = 0
+
+    def enqueue(self, neighbor, payload):
+        self.network.transmit(self.src, neighbor, payload)
+
+    def flush(self):
+        pass
+
+
+class SimRouter(Router):
+    def table_changed(self):
+        super().table_changed()
+        self.network.last_change = self.loop.time()
+
+
+def message_kind(payload):
+    # both wire formats carry the keys as plain strings
+    for kind in (b'chunk-request', b'rip-update', b'rip-resync', b'monitor-request', b'stats', b'table', b'lsa-ack', b'lsa', b'hello'):
+        if kind in payload:
+            return kind.decode()
+    return 'data'
+
+
+class Network:
+    def __init__(self, delay=0.001, loss=0.0, seed=0):
+        self.loop = VirtualLoop()
+        self.rng = random.Random(seed)
+        self.delay = delay
+        self.loss = loss
+        self.nodes = {}
+        self.links = {}
+        self.hosts = []
+        self.routers = []
+        self.monitor = None
+        self.messages = Counter()
+        self.bytes = Counter()
+        self.lost = 0
+        self.last_change = 0.0
+        self.cut_links = set()
+
+    def add(self, node):
+        node.loop = self.loop
+        node.sender = LinkSender(self, node.my_ip)
+        node.network = self
+        self.nodes[node.my_ip] = node
+        return node
+
+    def connect(self, a, b, delay=None, loss=None):
+        link = (self.delay if delay is None else delay, self.loss if loss is None else loss)
+        self.links[a, b] = self.links[b, a] = link
+
+    def cut(self, a, b):
+        """The link between a and b loses everything from now on, both nodes keep it as a neighbor"""
+        delay, _ = self.links[a, b]
+        self.links[a, b] = self.links[b, a] = (delay, 1.0)
+        self.cut_links.update(((a, b), (b, a)))
+
+    def transmit(self, src, dst, payload):
+        link = self.links.get((src, dst))
+        if link is None:
+            logger.error(f'No link from {src} to {dst}')
+            return
+        kind = message_kind(payload)
+        self.messages[kind] += 1
+        self.bytes[kind] += len(payload)
+        delay, loss = link
+        if loss and self.rng.random() < loss:
+            self.lost += 1
+            return
+        self.loop.call_later(delay, self.deliver, src, dst, payload)
+
+    def deliver(self, src, dst, payload):
+        node = self.nodes[dst]
+        node.spawn(node.handler.handle(payload, src))
+
+    @classmethod
+    def build(cls, router_links, host_links, delay_spread=0.0, areas={}, **kwargs):
+        """router_links: [(router, router)], host_links: [(host, router)], names are IPs.
+        areas: { router: link-state areas } for the routers that aren't only in AREAS"""
+        network = cls(**kwargs)
+        adjacency = {}
+        for a, b in itertools.chain(router_links, host_links):
+            adjacency.setdefault(a, []).append(b)
+            adjacency.setdefault(b, []).append(a)
+        host_ips = { host for host, _ in host_links }
+        for ip in sorted(adjacency):
+            if ip in host_ips:
+                network.hosts.append(network.add(Host(ip, adjacency[ip])))
+            else:
+                network.routers.append(network.add(SimRouter(ip, adjacency[ip], areas=areas.get(ip, AREAS))))
+        for a, b in itertools.chain(router_links, host_links):
+            network.connect(a, b, network.delay * (1 + network.rng.uniform(-delay_spread, delay_spread)))
+        network.monitor = network.add(Monitor(monitor_ip, [router.my_ip for router in network.routers]))
+        for router in network.routers:
+            network.connect(monitor_ip, router.my_ip)
+        return network
+
+    def boot(self, jitter=0.01):
+        """Every node starts up and says hello to its neighbors, like 'host.py start' does"""
+        for node in itertools.chain(self.hosts, self.routers):
+            self.loop.call_later(self.rng.uniform(0, jitter), node.broadcast)
+
+    def check_routes(self):
+        """(reachable, shortest, total) over all router -> host pairs, following each router's next hops"""
+        distances = {}
+        for host in self.hosts:
+            distances[host.my_ip] = distance = { host.my_ip: 0 }
+            queue = deque([host.my_ip])
+            while queue:
+                ip = queue.popleft()
+                for neighbor in self.nodes[ip].neighbors:
+                    if (ip, neighbor) in self.cut_links: continue
+                    if neighbor not in distance and isinstance(self.nodes[neighbor], Router):
+                        distance[neighbor] = distance[ip] + 1
+                        queue.append(neighbor)
+
+        reachable = shortest = total = 0
+        for router in self.routers:
+            for host in self.hosts:
+                if router.my_ip not in distances[host.my_ip]: continue
+                total += 1
+                hops, ip = 0, router.my_ip
+                while ip != host.my_ip and hops <= len(self.routers):
+                    node = self.nodes[ip]
+                    entry = node.handler.route(host.my_ip) if isinstance(node, Router) else None
+                    if entry is None or (ip, entry[0]) in self.cut_links: break
+                    ip, hops = entry[0], hops + 1
+                if ip == host.my_ip:
+                    reachable += 1
+                    shortest += hops == distances[host.my_ip][router.my_ip]
+        return reachable, shortest, total
+
+    def link_loads(self):
+        """Counter of the host -> host flows over each router -> router link, following each router's
+        choice for the flow"""
+        loads = Counter()
+        for src in self.hosts:
+            for dst in self.hosts:
+                if dst is src: continue
+                hops, ip = 0, src.neighbors[0]
+                while ip != dst.my_ip and hops <= len(self.routers):
+                    node = self.nodes[ip]
+                    next_hop = node.handler.next_hop(src.my_ip, dst.my_ip) if isinstance(node, Router) else None
+                    if next_hop is None: break
+                    if next_hop != dst.my_ip:
+                        loads[ip, next_hop] += 1
+                    ip, hops = next_hop, hops + 1
+        return loads
+
+
+# Same graphs as net1, net2 and net3 in topo.py
+def h(i): return f'10.0.0.{i}'
+def r(i): return f'10.0.0.{100 + i}'
+
+NETS = {
+    'net1': ([], [(h(1), r(1)), (h(2), r(1))]),
+    'net2': ([(r(1), r(2))], [(h(1), r(1)), (h(2), r(1)), (h(3), r(2))]),
+    'net3': (
+        [(r(2), r(1)), (r(1), r(3)), (r(3), r(10)), (r(9), r(10)), (r(9), r(2)), (r(3), r(4)), (r(4), r(5)),
+         (r(6), r(5)), (r(6), r(7)), (r(7), r(8)), (r(9), r(8)), (r(5), r(11)), (r(6), r(11)), (r(12), r(11))],
+        [(h(1), r(1)), (h(6), r(2)), (h(5), r(7)), (h(4), r(6)), (h(2), r(5)), (h(3), r(12))],
+    ),
+}
+
+def generated_ip(network, i):
+    return f'10.{network}.{i >> 8 & 0xff}.{i & 0xff}'
+
+def generate(shape, n, hosts=None, seed=0):
+    """Router links for a generated topology of n routers, plus one host on each of `hosts` routers"""
+    rng = random.Random(seed)
+    routers = [generated_ip(1, i) for i in range(n)]
+    edge = routers
+    if shape == 'line':
+        links = list(zip(routers, routers[1:]))
+    elif shape == 'ring':
+        links = list(zip(routers, routers[1:] + routers[:1])) if n > 2 else list(zip(routers, routers[1:]))
+    elif shape == 'grid':
+        width = max(1, int(n ** 0.5))
+        links = [(routers[i], routers[i + 1]) for i in range(n - 1) if (i + 1) % width]
+        links += [(routers[i], routers[i + width]) for i in range(n - width)]
+    elif shape == 'random':
+        # random spanning tree plus extra links, average degree around 3
+        links = { tuple(sorted((routers[i], routers[rng.randrange(i)]))) for i in range(1, n) }
+        while len(links) < 1.5 * n and n > 3:
+            a, b = rng.sample(routers, 2)
+            links.add(tuple(sorted((a, b))))
+        links = sorted(links)
+    elif shape == 'scale-free':
+        # preferential attachment, every new router links to 2 existing ones
+        links, targets = [], []
+        for i in range(1, n):
+            others = { routers[0] } if i == 1 else set()
+            while len(others) < min(i, 2):
+                others.add(rng.choice(targets))
+            for other in sorted(others):
+                links.append((other, routers[i]))
+                targets += [other, routers[i]]
+    elif shape == 'fat-tree':
+        # k-ary fat tree with k^2 / 4 core routers and k pods of k / 2 aggregation and k / 2 edge routers,
+        # k is the largest even number that fits in n
+        k = 2
+        while 5 * (k + 2) ** 2 // 4 <= n:
+            k += 2
+        half = k // 2
+        routers = routers[:5 * k * k // 4]
+        core, pods = routers[:half * half], routers[half * half:]
+        links, edge = [], []
+        for pod in range(k):
+            aggregation = pods[pod * k:pod * k + half]
+            edge += pods[pod * k + half:pod * k + k]
+            for i, router in enumerate(aggregation):
+                links += [(router, edge_router) for edge_router in pods[pod * k + half:pod * k + k]]
+                links += [(router, core_router) for core_router in core[i * half:(i + 1) * half]]
+    else:
+        raise ValueError(f'Unknown topology {shape}')
+    hosts = n if hosts is None else hosts
+    attached = rng.sample(edge, min(hosts, len(edge)))
+    host_links = [(generated_ip(2, i), router) for i, router in enumerate(attached)]
+    return links, host_links
+
+
+def assign_areas(router_links, count, seed=0):
+    """{ router: areas } for count link-state areas: a connected backbone around the busiest router,
+    and the other areas grown outwards from routers next to it. Routers next to the backbone are
+    in it too, so every area reaches the backbone and the backbone stays in one piece. There are
+    fewer areas only where too few routers are next to any backbone, as on a line."""
+    adjacency = {}
+    for a, b in router_links:
+        adjacency.setdefault(a, []).append(b)
+        adjacency.setdefault(b, []).append(a)
+    if count <= 1 or not adjacency:
+        return {}
+    rng = random.Random(seed)
+    center = max(sorted(adjacency), key=lambda router: len(adjacency[router]))
+    # a backbone with too few routers next to it to start count - 1 areas from grows, up to half the
+    # network, and if that doesn't help either the smallest one with the most of them is used
+    best = None
+    size = len(adjacency) // count
+    while best is None or size <= len(adjacency) // 2:
+        area_of, pieces = backbone_pieces(adjacency, center, size)
+        # pieces smaller than half an area join the backbone, unless all of them are that small
+        rest = sum(len(piece) for piece in pieces)
+        kept = [piece for piece in pieces[:count - 1] if len(piece) * 2 * (count - 1) >= rest] or pieces[:1]
+        frontiers = [[router for router in piece if any(area_of.get(n) == BACKBONE for n in adjacency[router])] or piece for piece in kept]
+        starts = min(sum(len(frontier) for frontier in frontiers), count - 1)
+        if best is None or starts > best[0]:
+            best = (starts, area_of, pieces, kept, frontiers)
+        if starts == count - 1:
+            break
+        size += max(size // 16, 1)
+    _, area_of, pieces, kept, frontiers = best
+    for piece in pieces:
+        if piece not in kept:
+            for router in piece:
+                area_of[router] = BACKBONE
+
+    # areas start next to the backbone, so each has a border router. Every piece gets one, the
+    # remaining ones go to the pieces with the most routers per area
+    seeds = [1] * len(kept)
+    for _ in range(count - 1 - len(kept)):
+        candidates = [i for i in range(len(kept)) if seeds[i] < len(frontiers[i])]
+        if not candidates: break
+        seeds[max(candidates, key=lambda i: (len(kept[i]) / seeds[i], -i))] += 1
+    queues = {}
+    area = 0
+    for frontier, n in zip(frontiers, seeds):
+        for router in rng.sample(frontier, n):
+            area += 1
+            area_of[router] = area
+            queues[area] = deque([router])
+    sizes = Counter(area_of.values())
+    # the smallest area grows first, so they end up about the same size
+    while queues:
+        area = min(queues, key=lambda area: (sizes[area], area))
+        router = queues[area].popleft()
+        if not queues[area]:
+            del queues[area]
+        for neighbor in adjacency[router]:
+            if neighbor not in area_of:
+                area_of[neighbor] = area
+                sizes[area] += 1
+                queues.setdefault(area, deque()).append(neighbor)
+    return { router: (BACKBONE, area) if area != BACKBONE and any(area_of[n] == BACKBONE for n in adjacency[router]) else (area,)
+             for router, area in area_of.items() }
+
+def backbone_pieces(adjacency, center, size):
+    """({ router: BACKBONE } for the size routers nearest to center, the other routers in the pieces
+    that only touch each other through the backbone, largest first). An area can't grow across pieces."""
+    area_of = { center: BACKBONE }
+    queue = deque([center])
+    while queue and len(area_of) < size:
+        for neighbor in adjacency[queue.popleft()]:
+            if neighbor not in area_of and len(area_of) < size:
+                area_of[neighbor] = BACKBONE
+                queue.append(neighbor)
+    pieces = []
+    seen = set(area_of)
+    for router in sorted(adjacency):
+        if router in seen: continue
+        seen.add(router)
+        piece = [router]
+        for member in piece:
+            for neighbor in adjacency[member]:
+                if neighbor not in seen:
+                    seen.add(neighbor)
+                    piece.append(neighbor)
+        pieces.append(sorted(piece))
+    pieces.sort(key=len, reverse=True)
+    return area_of, pieces
+
+def number_hosts_by_area(host_links, areas):
+    """host_links with the hosts renumbered so each area's hosts share an aligned address block,
+    like sites that each get their own prefix, so border routers can summarize them"""
+    by_area = {}
+    for host, router in sorted(host_links):
+        by_area.setdefault(max(areas.get(router, AREAS)), []).append(router)
+    block = 1 << (max(len(routers) for routers in by_area.values()) - 1).bit_length()
+    return [(generated_ip(2, i * block + j), router) for i, area in enumerate(sorted(by_area)) for j, router in enumerate(by_area[area])]
+
+def simulate(protocol, router_links, host_links, delay=0.001, loss=0.0, delay_spread=0.0, seed=0, cut=None, areas={}, broadcast=None):
+    """Convergence from boot, or with cut=(a, b) the reconvergence after that link fails once
+    the network has converged and every node is saying hello. With broadcast=ttl the first host
+    then floods one broadcast, and the datagrams it took are counted"""
+    network = Network.build(router_links, host_links, delay_spread, areas, delay=delay, loss=loss, seed=seed)
+    started = time.perf_counter()
+    if protocol == 'rip':
+        # switching modes is setup, not part of what's measured, so a request lost to --loss is sent again
+        while not all(router.rip_mode for router in network.routers):
+            network.monitor.rip_mode(True)
+            network.loop.run()
+        network.messages.clear()
+        network.bytes.clear()
+        start = network.loop.time()
+        network.boot()
+        if loss:
+            for node in itertools.chain(network.hosts, network.routers):
+                node.liveness.start()
+            network.loop.run(until=start + RIP_LOSS_OBSERVE)
+        else:
+            network.loop.run()
+    elif protocol == 'link-state':
+        network.boot()
+        network.loop.run()
+        network.messages.clear()
+        network.bytes.clear()
+        start = network.loop.time()
+        # adjacencies form over hellos
+        for node in itertools.chain(network.hosts, network.routers):
+            node.liveness.start()
+        network.monitor.link_state_mode(True)
+        network.loop.run(until=start + LINK_STATE_OBSERVE)
+    else:
+        network.boot()
+        network.loop.run()
+        network.messages.clear()
+        network.bytes.clear()
+        start = network.loop.time()
+        network.monitor.trigger_ospf()
+        network.loop.run()
+    if cut is not None:
+        # hellos never stop, so from here on the loop only runs for a fixed virtual time
+        for node in itertools.chain(network.hosts, network.routers):
+            node.liveness.start()
+        network.loop.run(until=network.loop.time() + CUT_SETTLE)
+        network.messages.clear()
+        network.bytes.clear()
+        network.lost = 0
+        start = network.last_change = network.loop.time()
+        network.cut(*cut)
+        network.loop.run(until=start + CUT_OBSERVE)
+    wall_time = time.perf_counter() - started
+    reachable, shortest, total = network.check_routes()
+    loads = network.link_loads()
+    result = {
+        'protocol': protocol,
+        'routers': len(network.routers),
+        'hosts': len(network.hosts),
+        'converged': reachable == total,
+        'convergence_time': max(network.last_change - start, 0.0),
+        'messages': sum(network.messages.values()),
+        'bytes': sum(network.bytes.values()),
+        'lost': network.lost,
+        'reachable': reachable,
+        'shortest': shortest,
+        'pairs': total,
+        'routes': sum(len(router.forwarding_table) for router in network.routers) / max(len(network.routers), 1),
+        'max_load': max(loads.values(), default=0),
+        'wall_time': wall_time,
+        'by_kind': dict(network.messages),
+    }
+    if broadcast is not None:
+        network.messages.clear()
+        network.hosts[0].broadcast(broadcast)
+        network.loop.run(until=network.loop.time() + BROADCAST_OBSERVE)
+        result['broadcast_copies'] = network.messages['data']
+        result['links'] = len(router_links) + len(host_links)
+    return result
+
+
+def random_cut(router_links, seed=0):
+    return random.Random(seed).choice(sorted(router_links))
+
+def print_report(results):
+    print(f"{'protocol':10} {'routers':>7} {'hosts':>6} {'converged':>9} {'time (s)':>9} {'messages':>9} {'bytes':>11} {'lost':>5} {'reachable':>10} {'shortest':>9} {'routes':>7} {'max load':>8} {'wall (s)':>8}")
+    for result in results:
+        print(f"{result['protocol']:10} {result['routers']:7} {result['hosts']:6} {str(result['converged']):>9} {result['convergence_time']:9.3f} "
+              f"{result['messages']:9} {result['bytes']:11} {result['lost']:5} {result['reachable']:>5}/{result['pairs']:<4} "
+              f"{result['shortest']:9} {result['routes']:7.1f} {result['max_load']:8} {result['wall_time']:8.2f}")
+    for result in results:
+        if 'broadcast_copies' in result:
+            print(f"{result['protocol']}: one broadcast took {result['broadcast_copies']} datagrams over {result['links']} links")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate RIP and OSPF convergence without mininet')
+    parser.add_argument('topology', help='net1, net2, net3, line, ring, grid, random, scale-free or fat-tree')
+    parser.add_argument('size', nargs='?', type=int, default=100, help='number of routers for generated topologies')
+    parser.add_argument('--hosts', type=int, help='number of hosts for generated topologies (default: one per router)')
+    parser.add_argument('--protocol', choices=['rip', 'ospf', 'link-state', 'both', 'all'], default='all', help="'both' is rip and ospf")
+    parser.add_argument('--delay', type=float, default=0.001, help='link delay in seconds')
+    parser.add_argument('--delay-spread', type=float, default=0.0, help='each link delay is randomized by this fraction')
+    parser.add_argument('--loss', type=float, default=0.0, help='probability that a datagram is lost')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--areas', type=int, default=1, help='split the routers into this many link-state areas')
+    parser.add_argument('--cut', help="measure reconvergence after the link A,B (two IPs) fails, or 'random' for a random router link")
+    parser.add_argument('--broadcast', type=int, metavar='TTL', help='after convergence, count the datagrams of one broadcast with this ttl')
+    parser.add_argument('--verbose', action='store_true', help='keep the node logs and show messages by kind')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.setLevel(logging.CRITICAL)
+
+    if args.topology in NETS:
+        router_links, host_links = NETS[args.topology]
+    else:
+        router_links, host_links = generate(args.topology, args.size, args.hosts, args.seed)
+
+    areas = assign_areas(router_links, args.areas, args.seed)
+    if areas:
+        host_links = number_hosts_by_area(host_links, areas)
+        print(f"{len(set(area for router_areas in areas.values() for area in router_areas))} areas, "
+              f"{sum(len(router_areas) > 1 for router_areas in areas.values())} border routers")
+
+    # after the hosts are numbered by area, so a host link is named by the IPs the nodes really get
+    cut = None
+    if args.cut == 'random':
+        cut = random_cut(router_links, args.seed)
+    elif args.cut:
+        cut = tuple(args.cut.split(','))
+        if len(cut) != 2:
+            parser.error(f'--cut takes two IPs separated by a comma, not {args.cut!r}')
+        all_links = set(router_links).union(host_links)
+        if cut not in all_links and cut[::-1] not in all_links:
+            parser.error(f'--cut {args.cut}: there is no link between {cut[0]} and {cut[1]}')
+    if cut:
+        print(f'Cutting the link {cut[0]} - {cut[1]}')
+
+    protocols = { 'both': ['rip', 'ospf'], 'all': ['rip', 'ospf', 'link-state'] }.get(args.protocol, [args.protocol])
+    results = [simulate(protocol, router_links, host_links, args.delay, args.loss, args.delay_spread, args.seed, cut, areas, args.broadcast) for protocol in protocols]
+    print_report(results)
+    if args.verbose:
+        for result in results:
+            print(result['protocol'], result['by_kind'])
@@ -0,0 +1,138 @@
+from collections import Counter
+
+# Runtime metrics of a node: plain counters ('forwarded', 'drop.ttl', 'rip.received', ...),
+# packets and bytes per neighbor, and latency histograms. A snapshot is a plain dict so it can
+# be sent to the monitor, which merges the snapshots of every router into one network-wide view.
+
+# histogram bucket i counts durations below 2^i microseconds, the last one everything longer
+HISTOGRAM_BUCKETS = 25
+
+
+class Histogram:
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[min(int(seconds * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+    def merge(self, snapshot):
+        self.count += snapshot['count']
+        self.total += snapshot['total']
+        self.max = max(self.max, snapshot['max'])
+        for i, n in enumerate(snapshot['buckets']):
+            self.buckets[i] += n
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket the given fraction of durations falls in, in seconds"""
+        remaining = fraction * self.count
+        for i, n in enumerate(self.buckets):
+            remaining -= n
+            if remaining <= 0:
+                return min((1 << i) / 1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        return { 'count': self.count, 'total': self.total, 'max': self.max, 'buckets': list(self.buckets) }
+
+
+class Stats:
+    def __init__(self):
+        self.counters = Counter()
+        self.neighbors = {}
+        self.histograms = {}
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def received(self, neighbor, size):
+        link = self.link(neighbor)
+        link[0] += 1
+        link[1] += size
+
+    def sent(self, neighbor, size):
+        link = self.link(neighbor)
+        link[2] += 1
+        link[3] += size
+
+    def link(self, neighbor):
+        """[rx packets, rx bytes, tx packets, tx bytes] of the link to neighbor"""
+        link = self.neighbors.get(neighbor)
+        if link is None:
+            link = self.neighbors[neighbor] = [0, 0, 0, 0]
+        return link
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(seconds)
+
+    def snapshot(self):
+        return {
+            'counters': dict(self.counters),
+            'neighbors': { neighbor: dict(zip(('rx_packets', 'rx_bytes', 'tx_packets', 'tx_bytes'), link)) for neighbor, link in self.neighbors.items() },
+            'histograms': { name: histogram.snapshot() for name, histogram in self.histograms.items() },
+        }
+
+
+def merge(snapshots):
+    """Network-wide totals of { node: snapshot }: summed counters, merged histograms, and
+    packets and bytes per node over all its links"""
+    counters = Counter()
+    histograms = {}
+    nodes = {}
+    for node, snapshot in snapshots.items():
+        counters.update(snapshot['counters'])
+        for name, histogram in snapshot['histograms'].items():
+            histograms.setdefault(name, Histogram()).merge(histogram)
+        totals = nodes[node] = Counter()
+        for link in snapshot['neighbors'].values():
+            totals.update(link)
+    return counters, histograms, nodes
+
+def format_report(snapshots, hot_spots=5):
+    counters, histograms, nodes = merge(snapshots)
+    lines = [f'Stats of {len(snapshots)} nodes']
+    for name in sorted(counters):
+        lines.append(f'  {name:24} {counters[name]:12}')
+    for name in sorted(histograms):
+        histogram = histograms[name]
+        mean = histogram.total / histogram.count if histogram.count else 0.0
+        lines.append(f'  {name:24} n={histogram.count:<8} mean={mean * 1e3:.3f}ms p50<={histogram.percentile(0.5) * 1e3:.3f}ms '
+                     f'p99<={histogram.percentile(0.99) * 1e3:.3f}ms max={histogram.max * 1e3:.3f}ms')
+    lines.append('Busiest nodes (rx packets, rx bytes, tx packets, tx bytes):')
+    for node, totals in sorted(nodes.items(), key=lambda item: -item[1]['rx_packets'])[:hot_spots]:
+        lines.append(f"  {node:15} {totals['rx_packets']:10} {totals['rx_bytes']:12} {totals['tx_packets']:10} {totals['tx_bytes']:12}")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    print('Running tests')
+    stats = Stats()
+    stats.count('forwarded')
+    stats.count('drop.ttl', 2)
+    stats.received('10.0.0.1', 100)
+    stats.received('10.0.0.1', 50)
+    stats.sent('10.0.0.102', 30)
+    for seconds in (0.000001, 0.0005, 0.002, 0.003):
+        stats.observe('rip-merge', seconds)
+    snapshot = stats.snapshot()
+    assert snapshot['neighbors']['10.0.0.1'] == { 'rx_packets': 2, 'rx_bytes': 150, 'tx_packets': 0, 'tx_bytes': 0 }
+    assert snapshot['histograms']['rip-merge']['count'] == 4
+
+    counters, histograms, nodes = merge({ '10.0.0.101': snapshot, '10.0.0.102': snapshot })
+    assert counters == { 'forwarded': 2, 'drop.ttl': 4 }
+    assert nodes['10.0.0.101'] == { 'rx_packets': 2, 'rx_bytes': 150, 'tx_packets': 1, 'tx_bytes': 30 }
+    histogram = histograms['rip-merge']
+    assert histogram.count == 8 and histogram.max == 0.003
+    assert histogram.percentile(0.25) <= 0.000001 * 2
+    assert 0.002 <= histogram.percentile(0.99) <= 0.003
+    assert 'drop.ttl' in format_report({ '10.0.0.101': snapshot })
@@ -0,0 +1,292 @@
+import json
+import os
+import socket
+import struct
+import sys
+from array import array
+from collections.abc import Mapping
+from functools import lru_cache
+# c-spell: ignore aton ntoa
+
+# Two formats are understood on receive, the sender picks one:
+# - 'json': the original human readable format, handy for debugging
+# - 'binary': MAGIC + VERSION followed by one tagged value, where IPs are 4 bytes
+#   and forwarding tables are packed column by column: destinations, the distinct
+#   next hops, one next hop index byte per route, and 2 byte costs. Tables with prefix
+#   routes ('10.0.0.0/30') add one prefix length byte per route. Equal cost next hops
+#   ({ ip: [ip, ...] }) are packed the same way, with a count byte and index bytes per destination.
+# JSON messages always start with '{', so decode can tell them apart without any negotiation.
+FORMAT = os.environ.get('WIRE_FORMAT', 'binary')
+
+MAGIC = 0xb1
+VERSION = 3
+
+NONE, FALSE, TRUE, INT, NEG_INT, STR, IP, LIST, DICT, TABLE, FLOAT, PREFIX_TABLE, PATHS = range(13)
+HOST_LENGTH = 0xff
+
+MAX_TABLE_COST = 0xffff
+MAX_TABLE_NEXT_HOPS = 0xff
+
+
+def encode(data, format=None):
+    if (format or FORMAT) == 'json':
+        return bytes(json.dumps(data, default=dict), 'utf-8')
+    out = bytearray((MAGIC, VERSION))
+    encode_value(out, data)
+    return bytes(out)
+
+def decode(data):
+    if data[0] != MAGIC:
+        return json.loads(data.decode('utf-8'))
+    if not 1 <= data[1] <= VERSION:
+        raise ValueError(f'Unsupported wire version {data[1]}')
+    value, _ = decode_value(data, 2)
+    return value
+
+
+@lru_cache(maxsize=1 << 16)
+def ip_bytes(value):
+    """4 byte form of a dotted IPv4 string, or None if value is not exactly one"""
+    if not isinstance(value, str) or value.count('.') != 3:
+        return None
+    try:
+        packed = socket.inet_aton(value)
+    except OSError:
+        return None
+    return packed if socket.inet_ntoa(packed) == value else None
+
+ip_string = lru_cache(maxsize=1 << 16)(socket.inet_ntoa)
+
+@lru_cache(maxsize=1 << 16)
+def prefix_bytes(value):
+    """(4 byte network, length) of a 'a.b.c.d/n' string, or None if value is not exactly one"""
+    if not isinstance(value, str):
+        return None
+    ip, _, length = value.partition('/')
+    packed = ip_bytes(ip)
+    if packed is None or not length.isdigit() or str(int(length)) != length or int(length) > 32:
+        return None
+    return packed, int(length)
+
+def prefix_string(packed, length):
+    ip = ip_string(packed)
+    return ip if length == HOST_LENGTH else f'{ip}/{length}'
+
+def encode_table(out, table):
+    """Appends a { ip: (ip, cost) } table in packed form. Returns False, writing nothing, if it doesn't have that shape"""
+    dsts = list(map(ip_bytes, table))
+    lengths = None
+    if None in dsts:
+        prefixes = [prefix_bytes(dst) if packed is None else (packed, HOST_LENGTH) for dst, packed in zip(table, dsts)]
+        if None in prefixes:
+            return False
+        dsts = [packed for packed, _ in prefixes]
+        lengths = bytes(length for _, length in prefixes)
+    next_hops = {}
+    indexes = bytearray()
+    costs = array('H')
+    for entry in table.values():
+        if not isinstance(entry, (list, tuple)) or len(entry) != 2:
+            return False
+        next_hop, cost = entry
+        if type(cost) is not int or not 0 <= cost <= MAX_TABLE_COST:
+            return False
+        index = next_hops.get(next_hop)
+        if index is None:
+            if ip_bytes(next_hop) is None or len(next_hops) == MAX_TABLE_NEXT_HOPS:
+                return False
+            index = next_hops[next_hop] = len(next_hops)
+        indexes.append(index)
+        costs.append(cost)
+    if sys.byteorder == 'little':
+        costs.byteswap()
+    out.append(TABLE if lengths is None else PREFIX_TABLE)
+    encode_varint(out, len(dsts))
+    out += b''.join(dsts)
+    if lengths is not None:
+        out += lengths
+    encode_varint(out, len(next_hops))
+    out += b''.join(map(ip_bytes, next_hops))
+    out += indexes
+    out += costs.tobytes()
+    return True
+
+def encode_paths(out, paths):
+    """Appends a { ip: [ip, ...] } dict in packed form. Returns False, writing nothing, if it doesn't have that shape"""
+    dsts = list(map(ip_bytes, paths))
+    if None in dsts:
+        return False
+    next_hops = {}
+    indexes = bytearray()
+    for hops in paths.values():
+        if not isinstance(hops, (list, tuple)) or not 0 < len(hops) <= MAX_TABLE_NEXT_HOPS:
+            return False
+        indexes.append(len(hops))
+        for next_hop in hops:
+            index = next_hops.get(next_hop)
+            if index is None:
+                if ip_bytes(next_hop) is None or len(next_hops) == MAX_TABLE_NEXT_HOPS:
+                    return False
+                index = next_hops[next_hop] = len(next_hops)
+            indexes.append(index)
+    out.append(PATHS)
+    encode_varint(out, len(dsts))
+    out += b''.join(dsts)
+    encode_varint(out, len(next_hops))
+    out += b''.join(map(ip_bytes, next_hops))
+    out += indexes
+    return True
+
+def decode_paths(data, i):
+    n, i = decode_varint(data, i)
+    dsts = map(ip_string, struct.unpack_from('4s' * n, data, i))
+    i += 4 * n
+    k, i = decode_varint(data, i)
+    next_hops = list(map(ip_string, struct.unpack_from('4s' * k, data, i)))
+    i += 4 * k
+    paths = {}
+    for dst in dsts:
+        count = data[i]
+        paths[dst] = [next_hops[index] for index in data[i + 1:i + 1 + count]]
+        i += 1 + count
+    return paths, i
+
+def decode_table(data, i, prefixes=False):
+    n, i = decode_varint(data, i)
+    dsts = struct.unpack_from('4s' * n, data, i)
+    i += 4 * n
+    if prefixes:
+        dsts = map(prefix_string, dsts, data[i:i + n])
+        i += n
+    else:
+        dsts = map(ip_string, dsts)
+    k, i = decode_varint(data, i)
+    next_hops = list(map(ip_string, struct.unpack_from('4s' * k, data, i)))
+    i += 4 * k
+    indexes = data[i:i + n]
+    i += n
+    costs = array('H', data[i:i + 2 * n])
+    if sys.byteorder == 'little':
+        costs.byteswap()
+    return dict(zip(dsts, zip(map(next_hops.__getitem__, indexes), costs))), i + 2 * n
+
+
+def encode_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def decode_varint(data, i):
+    n = shift = 0
+    while True:
+        byte = data[i]
+        i += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, i
+        shift += 7
+
+def encode_value(out, value):
+    if value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif isinstance(value, int):
+        out.append(INT if value >= 0 else NEG_INT)
+        encode_varint(out, abs(value))
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out += struct.pack('!d', value)
+    elif isinstance(value, str):
+        packed = ip_bytes(value)
+        if packed is not None:
+            out.append(IP)
+            out += packed
+        else:
+            raw = value.encode('utf-8')
+            out.append(STR)
+            encode_varint(out, len(raw))
+            out += raw
+    elif isinstance(value, (list, tuple)):
+        out.append(LIST)
+        encode_varint(out, len(value))
+        for item in value:
+            encode_value(out, item)
+    elif isinstance(value, Mapping):
+        if value and (encode_table(out, value) or encode_paths(out, value)):
+            return
+        out.append(DICT)
+        encode_varint(out, len(value))
+        for key, item in value.items():
+            encode_value(out, key)
+            encode_value(out, item)
+    else:
+        raise TypeError(f'Cannot encode {type(value).__name__}')
+
+def decode_value(data, i):
+    tag = data[i]
+    i += 1
+    if tag == NONE:
+        return None, i
+    if tag == TRUE:
+        return True, i
+    if tag == FALSE:
+        return False, i
+    if tag == INT or tag == NEG_INT:
+        n, i = decode_varint(data, i)
+        return (n if tag == INT else -n), i
+    if tag == FLOAT:
+        return struct.unpack_from('!d', data, i)[0], i + 8
+    if tag == STR:
+        n, i = decode_varint(data, i)
+        return data[i:i + n].decode('utf-8'), i + n
+    if tag == IP:
+        return ip_string(data[i:i + 4]), i + 4
+    if tag == LIST:
+        n, i = decode_varint(data, i)
+        result = []
+        for _ in range(n):
+            item, i = decode_value(data, i)
+            result.append(item)
+        return result, i
+    if tag == DICT:
+        n, i = decode_varint(data, i)
+        result = {}
+        for _ in range(n):
+            key, i = decode_value(data, i)
+            result[key], i = decode_value(data, i)
+        return result, i
+    if tag == TABLE or tag == PREFIX_TABLE:
+        return decode_table(data, i, tag == PREFIX_TABLE)
+    if tag == PATHS:
+        return decode_paths(data, i)
+    raise ValueError(f'Unknown wire tag {tag}')
+
+
+if __name__ == '__main__':
+    print('Running tests')
+    table = { f'10.0.{i // 250}.{i % 250 + 1}': (f'10.0.0.{101 + i % 7}', i % 13 + 1) for i in range(1000) }
+    messages = [
+        { 'rip-update': table, 'src': '10.0.0.101', 'dst': '10.0.0.102', 'seq': 300, 'delta': False },
+        { 'monitor-request': 'set-table', 'table': table },
+        { 'monitor-request': 'set-table', 'table': table, 'paths': { dst: ['10.0.0.101', next_hop] for dst, (next_hop, _) in table.items() } },
+        { 'x': { '10.0.0.1': [], '10.0.0.2': ['h1'] } },
+        { 'table': {} },
+        { 'table': { '10.0.0.0/30': ('10.0.0.101', 2), '10.0.0.9': ('10.0.0.101', 2), '0.0.0.0/0': ('10.0.0.102', 7) } },
+        { 'table': { '10.0.0.0/33': ('10.0.0.101', 2), '10.0.0.0/01': ('10.0.0.101', 2) } },
+        { 'monitor-request': 'change-rip-status', 'enabled': True },
+        { 'src': '10.0.0.1', 'dst': 'ALL', 'ttl': 0, 'x': [None, -5, 1.5, 'h1', { 'a': ('h1', 1) }] },
+    ]
+    for message in messages:
+        for format in ('json', 'binary'):
+            assert json.dumps(decode(encode(message, format))) == json.dumps(message)
+    assert len(encode(messages[0], 'binary')) * 4 < len(encode(messages[0], 'json'))
+
+    # forwarding tables are mappings, not necessarily dicts
+    from fib import ForwardingTable
+    packed = ForwardingTable(table)
+    for format in ('json', 'binary'):
+        assert json.dumps(decode(encode({ 'table': packed }, format))) == json.dumps({ 'table': dict(packed) })